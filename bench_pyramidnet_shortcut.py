@@ -0,0 +1,135 @@
+"""
+Micro-benchmark of the PyramidNet shortcut: the previous padding, a new zero tensor with
+requires_grad created on the host and copied to the device every forward, against
+image_models.pyramidnet.add_shortcut, which reuses zeros every block keeps on the device.
+Times the shortcuts alone on the shapes of the model, and a whole training step of the
+model with either implementation, forward + backward, on CPU by default.
+
+  python bench_pyramidnet_shortcut.py --model pyramidnet_270_110_bottleneck --batch_size 32
+"""
+import time
+import torch
+from absl import app
+from absl import flags
+import image_models.pyramidnet as pyramidnet
+import image_models.factory as model_factory
+from image_models.utils import memory_format_of
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('model', 'pyramidnet_270_110_bottleneck', 'pyramidnet model of image_models.factory to benchmark')
+flags.DEFINE_integer('batch_size', 32, 'batch size of the benchmark')
+flags.DEFINE_integer('iters', 20, 'timed iterations per measurement')
+flags.DEFINE_integer('warmup', 3, 'untimed iterations before every measurement')
+flags.DEFINE_integer('rounds', 3, 'alternating measurements of both implementations, the best one is reported')
+flags.DEFINE_boolean('use_cuda', False, 'whether to benchmark on GPU')
+flags.DEFINE_boolean('channels_last', False, 'whether to run the model and the shortcuts in channels_last')
+
+
+def zeros_cat_shortcut(out, shortcut, cache):
+    # NOTE: the implementation add_shortcut replaced, it keeps nothing in cache.
+    residual_channel = out.size()[1]
+    shortcut_channel = shortcut.size()[1]
+    if residual_channel != shortcut_channel:
+        featuremap_size = shortcut.size()[2:4]
+        padding = torch.zeros(
+            (out.size()[0],
+            residual_channel - shortcut_channel,
+            featuremap_size[0], featuremap_size[1]),
+            requires_grad=True, dtype=torch.float32).to(out.device, memory_format=memory_format_of(shortcut))
+        out += torch.cat((shortcut, padding), 1)
+    else:
+        out += shortcut
+    return out
+
+
+def best_of(fns, device):
+    # NOTE: alternate the implementations, so a drift of the machine does not favour one of them.
+    times = [float('inf')] * len(fns)
+    for _ in range(FLAGS.rounds):
+        for i, fn in enumerate(fns):
+            times[i] = min(times[i], fn())
+    return times
+
+
+def timeit(fn, device):
+    for _ in range(FLAGS.warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(FLAGS.iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / FLAGS.iters
+
+
+def shortcut_shapes(model, batch_size, device):
+    """(out shape, shortcut shape) of every block whose shortcut gets padded."""
+    shapes = []
+    def record(out, shortcut, cache):
+        if out.size()[1] != shortcut.size()[1]:
+            shapes.append((tuple(out.size()), tuple(shortcut.size())))
+        return pyramidnet_add_shortcut(out, shortcut, cache)
+    pyramidnet.add_shortcut = record
+    try:
+        with torch.no_grad():
+            model(torch.rand(batch_size, 3, 32, 32, device=device))
+    finally:
+        pyramidnet.add_shortcut = pyramidnet_add_shortcut
+    return shapes
+
+
+def bench_shortcut(shapes, device, memory_format):
+    inputs = []
+    for out_shape, shortcut_shape in shapes:
+        out = torch.rand(out_shape, device=device).contiguous(memory_format=memory_format).requires_grad_()
+        shortcut = torch.rand(shortcut_shape, device=device).contiguous(memory_format=memory_format).requires_grad_()
+        # NOTE: the zeros of every shortcut are kept in its own dict, as by its block.
+        inputs.append((out, shortcut, {}))
+    for out, shortcut, cache in inputs:
+        assert torch.equal(zeros_cat_shortcut(out.clone(), shortcut, {}), pyramidnet_add_shortcut(out.clone(), shortcut, cache))
+    def step(fn):
+        # NOTE: clone so the in place add has a non leaf to work on, as in the blocks.
+        total = sum(fn(out.clone(), shortcut, cache).sum() for out, shortcut, cache in inputs)
+        total.backward()
+    return best_of([lambda: timeit(lambda: step(zeros_cat_shortcut), device),
+                    lambda: timeit(lambda: step(pyramidnet_add_shortcut), device)], device)
+
+
+def bench_model(model, batch_size, device, memory_format):
+    data = torch.rand(batch_size, 3, 32, 32, device=device).contiguous(memory_format=memory_format)
+    target = torch.randint(0, 10, (batch_size,), device=device)
+    loss_op = torch.nn.CrossEntropyLoss()
+    def step():
+        model.zero_grad()
+        loss_op(model(data), target).backward()
+    def run(shortcut):
+        pyramidnet.add_shortcut = shortcut
+        try:
+            return timeit(step, device)
+        finally:
+            pyramidnet.add_shortcut = pyramidnet_add_shortcut
+    return best_of([lambda: run(zeros_cat_shortcut), lambda: run(pyramidnet_add_shortcut)], device)
+
+
+pyramidnet_add_shortcut = pyramidnet.add_shortcut
+
+
+def main(argv):
+    del argv
+    device = torch.device("cuda" if FLAGS.use_cuda else "cpu")
+    memory_format = torch.channels_last if FLAGS.channels_last else torch.contiguous_format
+    model = model_factory.get_model(FLAGS.model, 'cifar10', 10).to(device, memory_format=memory_format)
+    shapes = shortcut_shapes(model, FLAGS.batch_size, device)
+    print("%s: %d padded shortcuts per step, batch size %d, %s, %s" % (
+        FLAGS.model, len(shapes), FLAGS.batch_size, str(device), str(memory_format)))
+
+    old, new = bench_shortcut(shapes, device, memory_format)
+    print("shortcuts only, fwd+bwd: zeros+cat %.4f sec/step, add_shortcut %.4f sec/step, %.2fx" % (old, new, old / new))
+    old, new = bench_model(model, FLAGS.batch_size, device, memory_format)
+    print("training step:           zeros+cat %.4f sec/step, add_shortcut %.4f sec/step, %.2fx" % (old, new, old / new))
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,267 @@
+"""
+Fans the interference sweep out to worker agents.
+
+The coordinator turns models_to_run.sets x _default_batch_size into a job matrix and
+hands one cell at a time to every connected worker over a (local or remote) socket.
+Workers run the cell with model_interference_test.run() and send back their
+experiment.log lines and application_time.csv rows, which the coordinator gathers in
+one place. Jobs of a worker that dies are handed to the next free worker, a job that
+raises or kills its worker counts as a failed attempt of its runs.
+The coordinator keeps an experiment_ledger in output_dir, so a restarted sweep only hands
+out the runs that are not completed yet, and failed runs go out again up to the retry cap.
+
+  python experiment_coordinator.py --role coordinator --local_workers 4
+  python experiment_coordinator.py --role worker --address coordinator-host:6000
+"""
+import os
+import sys
+import csv
+import copy
+import queue
+import socket
+import threading
+import traceback
+import subprocess
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from absl import app
+from absl import flags
+import models_to_run
+import experiment_ledger
+import model_interference_test as mit
+import multiprocess_appfinishtime as app_time
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_enum('role', 'coordinator', ['coordinator', 'worker'], 'Whether to hand out jobs or to run them')
+flags.DEFINE_string('address', 'localhost:6000', 'host:port the coordinator listens on and workers connect to')
+flags.DEFINE_string('authkey', 'interference', 'Shared secret between the coordinator and its workers')
+flags.DEFINE_string('output_dir', None, 'Where the coordinator gathers experiment.log and application_time.csv, defaults to the project directory')
+flags.DEFINE_string('work_dir', None, 'Where a worker runs its jobs, defaults to a per worker directory in the project directory')
+flags.DEFINE_integer('local_workers', 0, 'Number of worker agents the coordinator starts on this machine')
+
+
+def project_dir():
+    return os.path.abspath(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+def job_matrix(sets, batch_sizes, ledger=None):
+    # NOTE: one job per (batch size, set), the same order main() runs them in.
+    jobs = []
+    all_runs = range(mit._START, mit._RUNS_PER_SET+mit._START)
+    for b in batch_sizes:
+        for experiment_index, ex in enumerate(sets):
+            runs = [r for r in all_runs
+                    if ledger is None or ledger.should_run(experiment_ledger.cell_key(experiment_index, b, r))]
+            if len(runs) == 0:
+                continue
+            jobs.append({'job_id': len(jobs), 'batch_size': b, 'set_index': experiment_index,
+                         'models': ex, 'total_length': len(sets), 'runs': runs})
+    return jobs
+
+
+class Coordinator(object):
+    """Hands out jobs to connected workers and gathers their results."""
+
+    def __init__(self, jobs, output_dir, ledger=None):
+        self.ledger = ledger
+        self.jobs = queue.Queue()
+        for job in jobs:
+            self.jobs.put(job)
+        self.remaining = len(jobs)
+        self.output_dir = output_dir
+        self.app_rows = []
+        self.lock = threading.Lock()
+        self.connected = 0
+        self.done = threading.Event()
+        if self.remaining == 0:
+            self.done.set()
+
+    def accept(self, listener):
+        # NOTE: keep accepting once done, so a late worker gets its stop instead of waiting in Client.
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError as e:
+                print('worker failed to authenticate: %s' % str(e))
+                continue
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        job = None
+        worker = None
+        try:
+            hello = conn.recv()
+            worker = hello['worker']
+            with self.lock:
+                self.connected += 1
+            print('worker %s connected' % worker)
+            while True:
+                try:
+                    job = self.jobs.get(timeout=1)
+                except queue.Empty:
+                    # NOTE: jobs of dead workers get requeued, only stop once everything is gathered.
+                    if self.done.is_set():
+                        conn.send({'type': 'stop'})
+                        return
+                    continue
+                job_msg = dict(job)
+                job_msg['type'] = 'job'
+                conn.send(job_msg)
+                result = conn.recv()
+                self.collect(job, result)
+                job = None
+        except (EOFError, OSError):
+            if job is not None:
+                print('worker %s lost job %d' % (worker, job['job_id']))
+                if self.ledger is None:
+                    self.jobs.put(job)
+                else:
+                    # NOTE: every run of a lost job failed, so a job that kills its workers stops at the retry cap.
+                    self.collect(job, {'worker': worker, 'runs': {}, 'experiment_log': [], 'app_rows': []})
+        finally:
+            if worker is not None:
+                with self.lock:
+                    self.connected -= 1
+            conn.close()
+
+    def collect(self, job, result):
+        with self.lock:
+            experiment_path = os.path.join(self.output_dir, 'experiment'+str(job['batch_size']))
+            if not os.path.exists(experiment_path):
+                os.makedirs(experiment_path)
+            with open(os.path.join(experiment_path, 'experiment.log'), 'a+') as average_file:
+                average_file.writelines(result['experiment_log'])
+            self.app_rows += result['app_rows']
+            retry = []
+            if self.ledger is not None:
+                for run_index in job['runs']:
+                    key = experiment_ledger.cell_key(job['set_index'], job['batch_size'], run_index)
+                    status = result['runs'].get(run_index, experiment_ledger.FAILED)
+                    self.ledger.record(key, status, worker=result['worker'])
+                    if status != experiment_ledger.COMPLETED and self.ledger.should_run(key):
+                        retry.append(run_index)
+            if len(retry) > 0:
+                print('job %d failed runs %s on %s, requeueing' % (job['job_id'], str(retry), result['worker']))
+                job = dict(job)
+                job['runs'] = retry
+                self.jobs.put(job)
+                return
+            self.remaining -= 1
+            print('job %d finished by %s, %d remaining' % (job['job_id'], result['worker'], self.remaining))
+            if self.remaining == 0:
+                self.done.set()
+
+    def write_app_time(self):
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        apptime_f = os.path.join(self.output_dir, "application_time.csv")
+        with open(apptime_f, 'w+') as app_time_handle:
+            field_names = ['model_runs', 'model', 'application_runtime(s)']
+            csv_writer = csv.DictWriter(app_time_handle, field_names, delimiter=',', lineterminator='\n')
+            csv_writer.writeheader()
+            for k, v, m in self.app_rows:
+                csv_writer.writerow({'model_runs': k, 'model': m, 'application_runtime(s)': v})
+
+
+def run_coordinator(address, authkey, output_dir, local_workers=0):
+    ledger = experiment_ledger.Ledger(os.path.join(output_dir, 'ledger.jsonl'))
+    jobs = job_matrix(copy.deepcopy(models_to_run.sets), mit._default_batch_size, ledger)
+    coordinator = Coordinator(jobs, output_dir, ledger)
+    if coordinator.done.is_set():
+        print("Every run of the ledger is completed, nothing to do.")
+        return coordinator
+    listener = Listener(parse_address(address), authkey=authkey)
+    threading.Thread(target=coordinator.accept, args=(listener,), daemon=True).start()
+
+    workers = []
+    for i in range(local_workers):
+        cmd = [sys.executable, os.path.abspath(__file__), '--role', 'worker',
+               '--address', address, '--authkey', authkey.decode(),
+               '--work_dir', os.path.join(output_dir, 'worker'+str(i))]
+        workers.append(subprocess.Popen(cmd))
+    try:
+        while not coordinator.done.wait(1):
+            # NOTE: without local workers the sweep waits for remote ones to connect.
+            if len(workers) > 0 and all(p.poll() is not None for p in workers) and coordinator.connected == 0:
+                print("Every local worker exited and no worker is connected, %d jobs left." % coordinator.remaining)
+                break
+        if not mit._PROF_ONLY:
+            coordinator.write_app_time()
+        for p in workers:
+            p.wait()
+    finally:
+        listener.close()
+        for p in workers:
+            if p.poll() is None:
+                p.kill()
+    print("Done.")
+    return coordinator
+
+
+def run_job(job, work_dir):
+    b = job['batch_size']
+    experiment_path = os.path.join(work_dir, 'experiment'+str(b))
+    current_experiment_path = os.path.join(experiment_path, str(job['set_index']))
+    job_log = os.path.join(current_experiment_path, 'experiment.log')
+    # NOTE: a requeued job may land on the same worker again, only report this attempt.
+    if os.path.exists(job_log):
+        os.remove(job_log)
+    statuses = mit.run(b, job_log, current_experiment_path, job['models'], job['total_length'], job['set_index'], runs=job['runs'])
+
+    experiment_log = []
+    if os.path.exists(job_log):
+        with open(job_log, 'r') as f:
+            experiment_log = f.readlines()
+    app_rows = []
+    for dir_path, subdirs, filenames in os.walk(current_experiment_path):
+        if "nvprof" in dir_path: continue
+        if "err.log" in filenames:
+            row = app_time.get_app_finish_time(os.path.join(dir_path, "err.log"))
+            if row is not None:
+                app_rows.append(row)
+    return experiment_log, app_rows, statuses or {}
+
+
+def run_worker(address, authkey, work_dir):
+    name = '%s:%d' % (socket.gethostname(), os.getpid())
+    conn = Client(parse_address(address), authkey=authkey)
+    try:
+        conn.send({'type': 'ready', 'worker': name})
+        while True:
+            msg = conn.recv()
+            if msg['type'] == 'stop':
+                break
+            print('worker %s running job %d' % (name, msg['job_id']))
+            try:
+                experiment_log, app_rows, statuses = run_job(msg, work_dir)
+            except Exception:
+                # NOTE: report the runs as failed, the ledger of the coordinator decides whether they go out again.
+                traceback.print_exc()
+                experiment_log, app_rows = [], []
+                statuses = {run_index: experiment_ledger.FAILED for run_index in msg['runs']}
+            conn.send({'worker': name, 'job_id': msg['job_id'], 'runs': statuses,
+                       'experiment_log': experiment_log, 'app_rows': app_rows})
+    finally:
+        conn.close()
+
+
+def main(argv):
+    del argv
+    authkey = FLAGS.authkey.encode()
+    if FLAGS.role == 'coordinator':
+        output_dir = FLAGS.output_dir if FLAGS.output_dir is not None else project_dir()
+        run_coordinator(FLAGS.address, authkey, output_dir, FLAGS.local_workers)
+    else:
+        work_dir = FLAGS.work_dir
+        if work_dir is None:
+            work_dir = os.path.join(project_dir(), 'worker_%s_%d' % (socket.gethostname(), os.getpid()))
+        run_worker(FLAGS.address, authkey, work_dir)
+
+if __name__ == "__main__":
+    app.run(main)
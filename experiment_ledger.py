@@ -0,0 +1,68 @@
+"""
+Durable record of which cells of a sweep are done, so an interrupted sweep can resume.
+
+Every attempt of a (set, batch size, run index) cell is appended to a JSONL file as one
+line and fsync-ed, a half written last line (crash mid-write) is ignored on load.
+An attempt that was started but never finished, e.g. it took the orchestrator down with
+it, counts as a failure, so a run that always crashes still stops at the retry cap.
+"""
+import os
+import json
+import time
+
+_MAX_RETRIES = 3
+
+STARTED = 'started'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+def cell_key(set_index, batch_size, run_index):
+    return '%d/%d/%d' % (set_index, batch_size, run_index)
+
+
+class Ledger(object):
+    """Append-only JSONL ledger of sweep cells keyed by cell_key()."""
+
+    def __init__(self, path, max_retries=_MAX_RETRIES):
+        self.path = path
+        self.max_retries = max_retries
+        self.cells = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._apply(entry)
+
+    def _apply(self, entry):
+        cell = self.cells.setdefault(entry['key'], {'status': None, 'failures': 0})
+        # NOTE: started again without a completed/failed record, the previous attempt crashed.
+        if entry['status'] == FAILED or (entry['status'] == STARTED and cell['status'] == STARTED):
+            cell['failures'] += 1
+        cell['status'] = entry['status']
+
+    def status(self, key):
+        return self.cells.get(key, {'status': None})['status']
+
+    def failures(self, key):
+        cell = self.cells.get(key, {'status': None, 'failures': 0})
+        # NOTE: a cell left 'started' means we crashed while it ran, that attempt failed.
+        return cell['failures'] + (1 if cell['status'] == STARTED else 0)
+
+    def should_run(self, key):
+        return self.status(key) != COMPLETED and self.failures(key) < self.max_retries
+
+    def record(self, key, status, **info):
+        entry = dict(info)
+        entry.update({'key': key, 'status': status, 'time': time.time()})
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path, 'a+') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._apply(entry)
@@ -4,9 +4,16 @@ from absl import flags
 # using predefined set of models
 import torchvision.datasets as predefined_datasets
 from image_models.model import EfficientNet
-from image_models.utils import save_ckpt
+from image_models.utils import check_memory_format
+from train_utils.checkpoint import CheckpointWriter, load_latest_checkpoint, restore_checkpoint
 import image_models.factory as model_factory
 import train_utils.data as data_utils
+from train_utils.augment import BatchAugment
+from train_utils.prefetcher import prefetch
+from train_utils.precision import Precision
+from train_utils.graph_compile import CompileCache, compile_key, compile_model, eval_model
+from train_utils.step_metrics import StepMetricsWriter
+from train_utils.step_timer import StepTimer, compute_time
 
 import torch
 import torch.optim as optim
@@ -44,7 +51,12 @@ flags.DEFINE_integer('max_epochs', 5, 'maximum number of epochs to run')
 flags.DEFINE_bool('profile_only', False, 'profile model FLOPs and Params only, not running the training procedure')
 flags.DEFINE_bool('profile_usev2', False, 'profile model FLOPs and Params using another ver., not running the training procedure')
 flags.DEFINE_string('ckpt_dir', None, 'directory to save ckpt')
-flags.DEFINE_bool('add_random_transforms', False, 'whether to add horizontal flip and vertical flip')
+flags.DEFINE_integer('ckpt_keep', 2, 'number of newest epoch ckpts to keep in ckpt_dir')
+flags.DEFINE_bool('async_ckpt', True, 'write ckpts from a background thread, the training loop only waits for the copy of the states to host memory')
+flags.DEFINE_enum('ckpt_format', 'torch', ['torch', 'flat'], 'format of the saved ckpts, flat ckpts are memory mapped and read lazily when resuming, see train_utils.checkpoint')
+flags.DEFINE_enum('ckpt_restore', 'all', ['all', 'model', 'optimizer'], 'which states to restore from the newest ckpt, the epoch is always resumed')
+flags.DEFINE_bool('add_random_transforms', False, 'whether to add horizontal flip, vertical flip, padded random crop and normalization as batched ops on the training device (train_utils.augment), in place of the per-sample flips of the data loader')
+flags.DEFINE_integer('random_crop_padding', 4, 'padding of the random crop of add_random_transforms, 0 disables the crop')
 # distributed settings
 # NOTE: We use N PROCESS N GPUS distributed method, because its the fastest for pytorch.
 flags.DEFINE_integer('num_gpus', 1, "Number of gpus to use within each rank.")
@@ -57,6 +69,20 @@ flags.DEFINE_string("dist_backend", None, "Which distributed backend to use, if
 flags.DEFINE_string("dist_method", None, "Which distributed method to use. e.g. starts with file://path/to/file, env://, tcp://IP:PORT. ")
 flags.DEFINE_integer("world_size", 1, "Number of distributed process. e.g. all the GPUs.")
 flags.DEFINE_integer('thread_workers', 2, 'Number of threads for data loader')
+flags.DEFINE_bool('persistent_workers', False, 'keep the data loader worker processes alive across epochs and evaluation passes instead of forking them at every pass')
+flags.DEFINE_integer('prefetch_factor', None, 'number of batches each data loader worker loads ahead, torch default if not set')
+flags.DEFINE_integer('eval_interval', 0, 'evaluate on the validation split every this many epochs, 0 never evaluates')
+flags.DEFINE_bool('synthetic_data', False, 'feed one random batch of the dataset shape, made once on the device, at every step instead of loading the dataset')
+flags.DEFINE_bool('prefetch', False, 'load the next batch onto the device while the current step computes: pinned memory and a side stream copy on cuda, a background thread otherwise')
+flags.DEFINE_bool('cache_dataset', False, 'decode the dataset once into a memory mapped uint8 .npy cache in dataset_dir/cache and flip whole batches, see train_utils.data.CachedLoader')
+flags.DEFINE_enum('memory_format', 'contiguous', ['contiguous', 'channels_last'], 'memory format of the model weights and of every input batch, channels_last is NHWC')
+flags.DEFINE_enum('compile', 'none', ['none', 'inductor', 'torchscript'], 'compile the model with torch.compile or TorchScript before training, falls back to eager when it does not compile, see train_utils.graph_compile')
+flags.DEFINE_string('compile_cache_file', None, 'JSON file keeping compile times and failures per (model, batch size, input shape), defaults to dataset_dir/cache/compile_times.json')
+flags.DEFINE_enum('precision', 'fp32', ['fp32', 'bf16', 'fp16'], 'train with autocast to this precision, fp16 also scales the loss with a GradScaler')
+flags.DEFINE_bool('sync_timing', False, 'synchronize the device at every timed phase boundary, so sec/step is device time and not launch latency')
+flags.DEFINE_integer('timing_warmup_steps', 0, 'number of first training steps left out of the timing statistics and step records')
+flags.DEFINE_bool('loader_stall_report', False, 'print the fraction of wall time spent blocked on the data loader at the end of training')
+flags.DEFINE_string('step_metrics_file', None, 'if set, append one binary record per training step to this file, see train_utils.step_metrics')
 
 flags.mark_flag_as_required('run_name')
 flags.mark_flag_as_required('model')
@@ -69,29 +95,70 @@ datasets_factory = {
   'svhn': predefined_datasets.SVHN,
 }
 
+memory_formats = {
+  'contiguous': torch.contiguous_format,
+  'channels_last': torch.channels_last,
+}
+
 datasets_shape = {
   'cifar10': (3, 32, 32),
-  'imagenet': (3, 224, 224)
+  'imagenet': (3, 224, 224),
+  'fashionmnist': (1, 28, 28),
+  'svhn': (3, 32, 32),
 }
 
 datasets_sizes = {
   'cifar10': 10,
-  'imagenet': 1000
+  'imagenet': 1000,
+  'fashionmnist': 10,
+  'svhn': 10,
+}
+
+# NOTE: number of training samples, so a synthetic epoch has as many steps as a real one.
+datasets_lengths = {
+  'cifar10': 50000,
+  'imagenet': 1281167,
+  'fashionmnist': 60000,
+  'svhn': 73257,
 }
 
-def _compute(device, dataloader, is_train, model, optimizer, loss_op, logger, epoch=None, log_interval=10, non_blocking=False, rank=0):
+def _compute(device, dataloader, is_train, model, optimizer, loss_op, logger, epoch=None, log_interval=10, non_blocking=False, rank=0, step_writer=None, timer=None, augment=None, precision=None, memory_format=None):
+  if timer is None:
+    timer = StepTimer(device)
+  if precision is None:
+    precision = Precision('fp32', device)
+  timer.reset_stats()
   epoch_start = time.time()
+  timer.start_step()
   for batch_idx, (data, target) in enumerate(dataloader):
+    timer.mark('data')
     data, target = data.to(device, non_blocking=non_blocking), target.to(device, non_blocking=non_blocking)
+    timer.mark('h2d')
+    if augment is not None:
+      data = augment(data, train=is_train)
+      timer.mark('augment')
+    if memory_format is not None:
+      data = data.contiguous(memory_format=memory_format)
+      timer.mark('h2d')
     if is_train:
       optimizer.zero_grad()
-    start_time = time.time()
-    pred = model(data)
+      timer.mark('optimizer')
+    with precision.autocast():
+      pred = model(data)
+    timer.mark('forward')
     if is_train:
-      loss = loss_op(pred, target)
-      loss.backward()
-      optimizer.step()
-    time_elapsed = time.time() - start_time
+      with precision.autocast():
+        loss = loss_op(pred, target)
+      precision.backward(loss)
+      timer.mark('backward')
+      precision.step(optimizer)
+      timer.mark('optimizer')
+    phases, measured = timer.end_step()
+    time_elapsed = compute_time(phases)
+    if is_train and step_writer is not None and measured:
+      # NOTE: only fetch the loss when we log it anyway, .item() would add a device sync per step.
+      step_loss = loss.item() if batch_idx % log_interval == 0 else float('nan')
+      step_writer.write(time_elapsed, step_loss, target.size(0))
     if epoch is not None:
       if batch_idx == 0:
         logger.info("Rank %d: First step of this epoch: %s", rank, str(datetime.datetime.utcnow()))
@@ -101,27 +168,71 @@ def _compute(device, dataloader, is_train, model, optimizer, loss_op, logger, ep
         logger.info("Rank %d: Last step of this epoch: %s, ran for %.4f", rank, str(datetime.datetime.utcnow()), epoch_elapsed)
 
       if batch_idx % log_interval == 0:
-        logger.info("Rank %d: Epoch %d: %d/%d [Loss: %.4f] (%.4f sec/step)", 
+        logger.info("Rank %d: Epoch %d: %d/%d [Loss: %.4f] (%.4f sec/step) [loader stall: %.4f sec]", 
                     rank, epoch, batch_idx*len(data), 
-                    len(dataloader.dataset), loss.item(), time_elapsed)
+                    len(dataloader.dataset), loss.item(), time_elapsed, phases['data'])
     else:
       if batch_idx % log_interval == 0 :
         _, predicted = torch.max(pred.data, 1)
         b_size = target.size(0)
         acc = (predicted == target).sum().item()
-        logger.info("Rank %d: [acc: %.4f] (%.4f sec/step)", rank, acc/b_size , time_elapsed)
+        logger.info("Rank %d: [acc: %.4f] (%.4f sec/step) [loader stall: %.4f sec]", rank, acc/b_size , time_elapsed, phases['data'])
+    timer.start_step()
 
+  if epoch is not None:
+    means = timer.summary()
+    logger.info("Rank %d: Epoch %d timing over %d steps (synced: %s): data %.4f h2d %.4f augment %.4f forward %.4f backward %.4f optimizer %.4f sec/step",
+                rank, epoch, timer.measured_steps, str(timer.sync),
+                means['data'], means['h2d'], means['augment'], means['forward'], means['backward'], means['optimizer'])
+    epoch_elapsed = time.time() - epoch_start
+    epoch_stall = timer.epoch_stall / 1e9
+    logger.info("Rank %d: Epoch %d loader stall: %.4f of %.4f secs (%.2f%%)", rank, epoch,
+                epoch_stall, epoch_elapsed, 100.0 * epoch_stall / epoch_elapsed if epoch_elapsed > 0 else 0.0)
 
-def compute(logger, model, device, loader, optimizer, loss_op, epoch=None, log_interval=10, is_train=True, rank=0):
+
+def compute(logger, model, device, loader, optimizer, loss_op, epoch=None, log_interval=10, is_train=True, rank=0, step_writer=None, timer=None, augment=None, non_blocking=False, precision=None, memory_format=None):
   if is_train:
     model.train()
     logger.info("Rank %d: training starts", rank)
-    _compute(device, loader, is_train, model, optimizer, loss_op, logger, epoch, log_interval, rank=rank)
+    _compute(device, loader, is_train, model, optimizer, loss_op, logger, epoch, log_interval, non_blocking=non_blocking, rank=rank, step_writer=step_writer, timer=timer, augment=augment, precision=precision, memory_format=memory_format)
   else:
     logger.info("Eval Starts")
     model.eval()
     with torch.no_grad():
-      _compute(device, loader, is_train, model, optimizer, loss_op, logger, epoch, log_interval, rank=rank)
+      _compute(device, loader, is_train, model, optimizer, loss_op, logger, epoch, log_interval, non_blocking=non_blocking, rank=rank, augment=augment, precision=precision, memory_format=memory_format)
+
+def to_memory_format(logger, model, memory_format, input_size, device, rank=0):
+  model = model.to(memory_format=memory_format)
+  if memory_format != torch.contiguous_format:
+    mismatched = check_memory_format(model, input_size, memory_format, device)
+    if len(mismatched) > 0:
+      logger.warning("Rank %d: %d modules do not keep %s, the ops after them work on a copy: %s", rank, len(mismatched), str(memory_format), ', '.join(mismatched))
+    else:
+      logger.info("Rank %d: all modules keep %s", rank, str(memory_format))
+  return model
+
+def compile_for_training(logger, model, backend, model_name, batch_size, input_shape, device, precision, memory_format, cache_file, rank=0):
+  example = torch.rand((batch_size,) + tuple(input_shape), device=device)
+  if memory_format is not None:
+    example = example.contiguous(memory_format=memory_format)
+  # NOTE: layout and precision change the compiled graph, they are part of the backend of the key.
+  label = '%s,%s,%s' % (backend, str(memory_format or torch.contiguous_format).split('.')[-1], precision.precision)
+  key = compile_key(model_name, label, batch_size, input_shape)
+  step_model, method, compile_secs, previous = compile_model(model, backend, example, precision, CompileCache(cache_file), key, logger)
+  logger.info("Rank %d: Compile: %s with %s in %.4f secs, previous run: %s", rank, key, method, compile_secs,
+              "%.4f secs" % previous if previous is not None else "none")
+  print("Compile_Time: rank %d, %s, %s, %.4f secs" % (rank, key, method, compile_secs))
+  return step_model, eval_model(model, step_model, method)
+
+def restore_parts(ckpt_restore, model, optimizer):
+  """(model, optimizer) to restore_checkpoint, None for the one ckpt_restore leaves out."""
+  return (model if ckpt_restore in ('all', 'model') else None,
+          optimizer if ckpt_restore in ('all', 'optimizer') else None)
+
+def report_loader_stall(logger, timer, rank):
+  stall, wall, fraction = timer.stall_report()
+  logger.info("Rank %d: loader stall: %.4f of %.4f secs (%.2f%%)", rank, stall, wall, 100.0 * fraction)
+  print("Loader_Stall: rank %d, %.2f%% of wall time waiting for input (%.4f of %.4f secs)" % (rank, 100.0 * fraction, stall, wall))
 
 def main(argv):
   del argv
@@ -160,45 +271,24 @@ def single_main():
 
   dataset_fn = datasets_factory[FLAGS.dataset]
   dataset_classes = datasets_sizes[FLAGS.dataset]
-  try:
-    have_ckpt = (FLAGS.ckpt_dir is not None and any("model_state_epoch" in x for x in os.listdir(FLAGS.ckpt_dir)))
-  except:
-    have_ckpt = False
-    
   model = model_factory.get_model(FLAGS.model, FLAGS.dataset, dataset_classes)
   optimizer = optim.Adam(model.parameters(), lr=0.001)
 
-  if have_ckpt:
-    files = os.listdir(FLAGS.ckpt_dir)
-    model_checkpoints = [x for x in files if "model_state_epoch" in x]
-    if len(model_checkpoints) > 0: 
-      logger.info("**********Found ckpt: %s" % model_checkpoints[-1])
-      ckpt_path = os.path.join(FLAGS.ckpt_dir, model_checkpoints[-1])
-      try:
-        ckpt = torch.load(ckpt_path)
-      except EOFError:
-        ckpt = None
-      if ckpt is not None:
-        current_epochs = ckpt['epoch']
-        model.load_state_dict(ckpt['model_state_dict'])
-        optimizer.load_state_dict(ckpt['optim_state_dict'])
-        # Move to device. 
-        for state in optimizer.state.values():
-          for k, v in state.items():
-            if isinstance(v, torch.Tensor):
-              state[k] = v.to(device)
-        logger.info("******Loaded ckpt")
-      else:
-        logger.info("Cannot load ckpt")
-        current_epochs = 1
-    else:
-      logger.info("No ckpt found")
-      current_epochs = 1
+  # NOTE: on the device before restoring, so the ckpt tensors are copied straight there.
+  model = model.to(device)
+  ckpt_path, ckpt = load_latest_checkpoint(FLAGS.ckpt_dir, map_location=device, logger=logger)
+  if ckpt is not None:
+    logger.info("**********Found ckpt: %s" % ckpt_path)
+    current_epochs = restore_checkpoint(ckpt, *restore_parts(FLAGS.ckpt_restore, model, optimizer))
+    logger.info("******Loaded ckpt")
   else:
     logger.info("No ckpt found")
     current_epochs = 1
 
-  model = model.to(device)
+  memory_format = None
+  if not FLAGS.profile_only and FLAGS.memory_format != 'contiguous':
+    memory_format = memory_formats[FLAGS.memory_format]
+    model = to_memory_format(logger, model, memory_format, (2,) + datasets_shape[FLAGS.dataset], device)
 
   if FLAGS.profile_only:
     stats = counter.profile(model, input_size=(FLAGS.batch_size,) + (datasets_shape[FLAGS.dataset]), logger=logger, is_cnn=True)
@@ -206,27 +296,67 @@ def single_main():
     print("DNN_Features: ", str(stats))
     return
 
-  train_loader, val_lodaer = data_utils.get_standard_dataloader(dataset_fn, FLAGS.dataset_dir, FLAGS.batch_size, download=True)
+  # NOTE: copies are only asynchronous from pinned memory.
+  pin_memory = FLAGS.prefetch and device.type == 'cuda'
+  val_loader = None
+  if FLAGS.synthetic_data:
+    train_loader = data_utils.SyntheticLoader(datasets_shape[FLAGS.dataset], dataset_classes, FLAGS.batch_size,
+                                              datasets_lengths[FLAGS.dataset], device)
+  else:
+    train_loader, val_loader = data_utils.get_standard_dataloader(dataset_fn, FLAGS.dataset_dir, FLAGS.batch_size, FLAGS.thread_workers, download=True, cache=FLAGS.cache_dataset,
+                                                                  random_flips=not FLAGS.add_random_transforms, pin_memory=pin_memory,
+                                                                  persistent_workers=FLAGS.persistent_workers, prefetch_factor=FLAGS.prefetch_factor)
+    if FLAGS.prefetch:
+      train_loader = prefetch(train_loader, device)
+      val_loader = prefetch(val_loader, device)
+  augment = None
+  if FLAGS.add_random_transforms:
+    augment = BatchAugment.for_dataset(FLAGS.dataset, crop_padding=FLAGS.random_crop_padding)
   
   loss_op = torch.nn.CrossEntropyLoss()
+  step_writer = None
+  if FLAGS.step_metrics_file is not None:
+    step_writer = StepMetricsWriter(FLAGS.step_metrics_file)
+  # NOTE: one timer for the whole run, warm up steps only happen once.
+  timer = StepTimer(device, FLAGS.sync_timing, FLAGS.timing_warmup_steps)
+  precision = Precision(FLAGS.precision, device)
+  # NOTE: train through step_model, but keep saving model, compiled wrappers rename the state dict keys.
+  step_model = model
+  eval_step_model = model
+  if FLAGS.compile != 'none':
+    compile_cache_file = FLAGS.compile_cache_file or os.path.join(FLAGS.dataset_dir, 'cache', 'compile_times.json')
+    step_model, eval_step_model = compile_for_training(logger, model, FLAGS.compile, FLAGS.model, FLAGS.batch_size, datasets_shape[FLAGS.dataset],
+                                      device, precision, memory_format, compile_cache_file)
   start_time = time.time()
 
+  ckpt_writer = None
+  if FLAGS.ckpt_dir is not None:
+    ckpt_writer = CheckpointWriter(FLAGS.ckpt_dir, FLAGS.ckpt_keep, logger, FLAGS.async_ckpt, FLAGS.ckpt_format)
   try:
     if _cudart is not None:
       status = _cudart.cudaProfilerStart()
     else:
       status = None
     for epoch in range(current_epochs, FLAGS.max_epochs+1):
-      compute(logger, model, device, train_loader, optimizer, loss_op, epoch=epoch, is_train=True, rank=0)
+      compute(logger, step_model, device, train_loader, optimizer, loss_op, epoch=epoch, is_train=True, rank=0, step_writer=step_writer, timer=timer, augment=augment, non_blocking=pin_memory, precision=precision, memory_format=memory_format)
+      if val_loader is not None and FLAGS.eval_interval > 0 and epoch % FLAGS.eval_interval == 0:
+        compute(logger, eval_step_model, device, val_loader, optimizer, loss_op, log_interval=FLAGS.log_interval, is_train=False, rank=0, augment=augment, non_blocking=pin_memory, precision=precision, memory_format=memory_format)
       # TODO: currently just ckpt every epoch
       # plus 1 because next time around is inclusive.
-      if FLAGS.ckpt_dir is not None:
-        save_ckpt(logger, epoch+1, model, optimizer, FLAGS.ckpt_dir)
+      if ckpt_writer is not None:
+        ckpt_writer.save(epoch+1, model, optimizer)
 
   finally:
     if status == 0:
       _cudart.cudaProfilerStop()
-
+    if ckpt_writer is not None:
+      # NOTE: waits for the last ckpt to be written.
+      ckpt_writer.close()
+    if step_writer is not None:
+      step_writer.close()
+
+  if FLAGS.loader_stall_report:
+    report_loader_stall(logger, timer, 0)
   final_time = time.time() - start_time
   logger.info("Finished: ran for %d secs", final_time)
     
@@ -258,6 +388,10 @@ def worker(gpu_index, ngpus_per_node, world_size, proc_flags):
   # Set cuda to a single gpu context  
   torch.cuda.set_device(gpu_index)
   model.cuda(gpu_index)
+  memory_format = None
+  if proc_flags['memory_format'] != 'contiguous':
+    memory_format = memory_formats[proc_flags['memory_format']]
+    model = to_memory_format(logger, model, memory_format, (2,) + datasets_shape[proc_flags['dataset']], torch.device("cuda:%d" % gpu_index), rank)
 
   batch_size = proc_flags['batch_size']
   thread_workers = proc_flags['thread_workers']
@@ -269,25 +403,13 @@ def worker(gpu_index, ngpus_per_node, world_size, proc_flags):
 
   # load ckpt if ckpt exists.
   ckpt_dir = proc_flags['ckpt_dir']
-  have_ckpt = (ckpt_dir is not None and any("model_state_epoch" in x for x in os.listdir(ckpt_dir)))
   location = "cuda:%d" % gpu_index
   device = torch.device(location)
-  if have_ckpt:
-    files = os.listdir(ckpt_dir)
-    model_checkpoints = [x for x in files if "model_state_epoch" in x]
-    logger.info("**********Found ckpt: %s" % model_checkpoints[-1])
-    # TODO: found the epoch ckpt, for now we just keep one.
-    ckpt_path = os.path.join(ckpt_dir, model_checkpoints[-1])
-    # NOTE: map model to be loaded to specified single GPU
-    ckpt = torch.load(ckpt_path, map_location=location)
-    current_epochs = ckpt['epoch']
-    model.load_state_dict(ckpt['model_state_dict'])
-    optimizer.load_state_dict(ckpt['optim_state_dict'])
-    # Move to device. 
-    for state in optimizer.state.values():
-      for k, v in state.items():
-        if isinstance(v, torch.Tensor):
-          state[k] = v.to(device)
+  # NOTE: map model to be loaded to specified single GPU
+  ckpt_path, ckpt = load_latest_checkpoint(ckpt_dir, map_location=location, logger=logger)
+  if ckpt is not None:
+    logger.info("**********Found ckpt: %s" % ckpt_path)
+    current_epochs = restore_checkpoint(ckpt, *restore_parts(proc_flags['ckpt_restore'], model, optimizer))
     logger.info("******Loaded ckpt")
   else:
     logger.info("No ckpt found")
@@ -296,18 +418,61 @@ def worker(gpu_index, ngpus_per_node, world_size, proc_flags):
 
   torch.backends.cudnn.deterministic = True
   dataset_dir = proc_flags['dataset_dir']
-  sampler, dist_train_loader, val_loader = data_utils.get_distribute_dataloader(dataset_fn, dataset_dir, batch_size, thread_workers, is_chief)
-  logger.info("*****Rank %d: each sampler has %d", rank, len(sampler))
+  pin_memory = proc_flags['prefetch']
+  val_loader = None
+  if proc_flags['synthetic_data']:
+    # NOTE: no sampler, every rank takes its share of the real split in steps.
+    sampler = None
+    num_samples = (datasets_lengths[proc_flags['dataset']] + world_size - 1) // world_size
+    dist_train_loader = data_utils.SyntheticLoader(datasets_shape[proc_flags['dataset']], dataset_classes, batch_size, num_samples, device)
+  else:
+    sampler, dist_train_loader, val_loader = data_utils.get_distribute_dataloader(dataset_fn, dataset_dir, batch_size, thread_workers, is_chief, cache=proc_flags['cache_dataset'],
+                                                                                        random_flips=not proc_flags['add_random_transforms'], pin_memory=pin_memory,
+                                                                                        persistent_workers=proc_flags['persistent_workers'], prefetch_factor=proc_flags['prefetch_factor'])
+    if proc_flags['prefetch']:
+      dist_train_loader = prefetch(dist_train_loader, device)
+      val_loader = prefetch(val_loader, device)
+  augment = None
+  if proc_flags['add_random_transforms']:
+    augment = BatchAugment.for_dataset(proc_flags['dataset'], crop_padding=proc_flags['random_crop_padding'])
+  if sampler is not None:
+    logger.info("*****Rank %d: each sampler has %d", rank, len(sampler))
   max_epochs = proc_flags['max_epochs']
+  step_writer = None
+  if proc_flags['step_metrics_file'] is not None:
+    # NOTE: one file per rank, rank 0 keeps the given name.
+    step_metrics_file = proc_flags['step_metrics_file'] + ('.%d' % rank if rank > 0 else '')
+    step_writer = StepMetricsWriter(step_metrics_file)
+  timer = StepTimer(device, proc_flags['sync_timing'], proc_flags['timing_warmup_steps'])
+  precision = Precision(proc_flags['precision'], device)
+  step_model = model
+  if proc_flags['compile'] != 'none':
+    compile_cache_file = proc_flags['compile_cache_file'] or os.path.join(dataset_dir, 'cache', 'compile_times.json')
+    step_model, _ = compile_for_training(logger, model, proc_flags['compile'], proc_flags['model'], batch_size, datasets_shape[proc_flags['dataset']],
+                                      device, precision, memory_format, compile_cache_file, rank)
+  ckpt_writer = None
+  if rank == 0 and ckpt_dir is not None:
+    ckpt_writer = CheckpointWriter(ckpt_dir, proc_flags['ckpt_keep'], logger, proc_flags['async_ckpt'], proc_flags['ckpt_format'])
   
   for epoch in range(current_epochs, max_epochs):
-    sampler.set_epoch(epoch)
-    compute(logger, model, device, dist_train_loader, optimizer, loss_op, epoch=epoch, log_interval=proc_flags['log_interval'], is_train=True, rank=rank)
+    if sampler is not None:
+      sampler.set_epoch(epoch)
+    compute(logger, step_model, device, dist_train_loader, optimizer, loss_op, epoch=epoch, log_interval=proc_flags['log_interval'], is_train=True, rank=rank, step_writer=step_writer, timer=timer, augment=augment, non_blocking=pin_memory, precision=precision, memory_format=memory_format)
+
+    # NOTE: rank 0 evaluates the unwrapped model alone, so the other ranks carry on without collectives.
+    if rank == 0 and val_loader is not None and proc_flags['eval_interval'] > 0 and epoch % proc_flags['eval_interval'] == 0:
+      compute(logger, model.module, device, val_loader, optimizer, loss_op, log_interval=proc_flags['log_interval'], is_train=False, rank=rank, augment=augment, non_blocking=pin_memory, precision=precision, memory_format=memory_format)
 
     # NOTE: controversal, only saving ckpt in rank 0, first machine, only first process.
     # assuming the ckpt dir is a nfs mounted for each machine
-    if rank == 0:
-      save_ckpt(logger, epoch+1, model, optimizer, ckpt_dir)
+    if ckpt_writer is not None:
+      ckpt_writer.save(epoch+1, model, optimizer)
+  if ckpt_writer is not None:
+    ckpt_writer.close()
+  if step_writer is not None:
+    step_writer.close()
+  if proc_flags['loader_stall_report']:
+    report_loader_stall(logger, timer, rank)
 
 
 if __name__ == "__main__":
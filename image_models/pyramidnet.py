@@ -6,6 +6,7 @@ import torch.nn as nn
 import math
 #from math import round
 import torch.utils.model_zoo as model_zoo
+from image_models.utils import memory_format_of
 
 
 def conv3x3(in_planes, out_planes, stride=1):
@@ -14,6 +15,32 @@ def conv3x3(in_planes, out_planes, stride=1):
                      padding=1, bias=False)
 
 
+def zero_channels(shortcut, channels, cache):
+    "zeros to concatenate to shortcut, allocated on its device once per shape and kept in cache"
+    memory_format = memory_format_of(shortcut)
+    # (batch, channels, height, width, device, dtype, memory format) -> zeros
+    key = (shortcut.size()[0], channels, shortcut.size()[2], shortcut.size()[3],
+           shortcut.device, shortcut.dtype, memory_format)
+    if key not in cache:
+        # NOTE: only the zeros of the last shape are kept, e.g. the smaller last batch replaces them.
+        cache.clear()
+        cache[key] = torch.zeros(
+            key[:4], dtype=shortcut.dtype, device=shortcut.device).contiguous(memory_format=memory_format)
+    return cache[key]
+
+
+def add_shortcut(out, shortcut, cache):
+    "out += shortcut zero padded to the channels of out, cache is the dict of the block keeping the zeros"
+    residual_channel = out.size()[1]
+    shortcut_channel = shortcut.size()[1]
+    if residual_channel != shortcut_channel:
+        # NOTE: the padding is a constant, it needs no gradient and no new tensor (nor host to device copy) per step.
+        out += torch.cat((shortcut, zero_channels(shortcut, residual_channel - shortcut_channel, cache)), 1)
+    else:
+        out += shortcut
+    return out
+
+
 class BasicBlock(nn.Module):
     outchannel_ratio = 1
 
@@ -27,6 +54,8 @@ class BasicBlock(nn.Module):
         self.relu = nn.ReLU(inplace=True)
         self.downsample = downsample
         self.stride = stride
+        # NOTE: zeros padding the shortcut, see add_shortcut.
+        self.shortcut_zeros = {}
 
     def forward(self, x):
 
@@ -39,26 +68,10 @@ class BasicBlock(nn.Module):
        
         if self.downsample is not None:
             shortcut = self.downsample(x)
-            featuremap_size = shortcut.size()[2:4]
         else:
             shortcut = x
-            featuremap_size = out.size()[2:4]
-
-        batch_size = out.size()[0]
-        residual_channel = out.size()[1]
-        shortcut_channel = shortcut.size()[1]
-
-        if residual_channel != shortcut_channel:
-            padding = torch.zeros(
-                (batch_size, 
-                residual_channel - shortcut_channel, 
-                featuremap_size[0], featuremap_size[1]), 
-                requires_grad=True, dtype=torch.float32).to(x.device)
-            out += torch.cat((shortcut, padding), 1)
-        else:
-            out += shortcut 
 
-        return out
+        return add_shortcut(out, shortcut, self.shortcut_zeros)
 
 
 class Bottleneck(nn.Module):
@@ -77,6 +90,8 @@ class Bottleneck(nn.Module):
         self.relu = nn.ReLU(inplace=True)
         self.downsample = downsample
         self.stride = stride
+        # NOTE: zeros padding the shortcut, see add_shortcut.
+        self.shortcut_zeros = {}
 
     def forward(self, x):
 
@@ -95,26 +110,10 @@ class Bottleneck(nn.Module):
 
         if self.downsample is not None:
             shortcut = self.downsample(x)
-            featuremap_size = shortcut.size()[2:4]
         else:
             shortcut = x
-            featuremap_size = out.size()[2:4]
-
-        batch_size = out.size()[0]
-        residual_channel = out.size()[1]
-        shortcut_channel = shortcut.size()[1]
-
-        if residual_channel != shortcut_channel:
-            padding = torch.zeros(
-                (batch_size, 
-                residual_channel - shortcut_channel, 
-                featuremap_size[0], featuremap_size[1]), 
-                dtype=torch.float32, requires_grad=True).to(x.device)
-            out += torch.cat((shortcut, padding), 1)
-        else:
-            out += shortcut 
 
-        return out
+        return add_shortcut(out, shortcut, self.shortcut_zeros)
 
 
 class PyramidNet(nn.Module):
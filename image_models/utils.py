@@ -12,6 +12,7 @@ from torch import nn
 from torch.nn import functional as F
 from torch.utils import model_zoo
 import os
+from train_utils.checkpoint import save_checkpoint, snapshot
 ########################################################################
 ############### HELPERS FUNCTIONS FOR MODEL ARCHITECTURE ###############
 ########################################################################
@@ -69,19 +70,32 @@ def drop_connect(inputs, p, training):
     return output
 
 class Pad2d(nn.Module):
-    def __init__(self, stride, dilation):
+    """ TensorFlow 'SAME' zero padding of the input of a conv, computed once per input size. """
+    def __init__(self, stride, dilation, kernel_size):
         super().__init__()
         self.sh, self.sw = stride
         self.dh, self.dw = dilation
+        self.kh, self.kw = kernel_size
+        self._pads = {}
+
+    def padding(self, ih, iw):
+        """ [left, right, top, bottom] padding of an ih x iw input. """
+        pads = self._pads.get((ih, iw))
+        if pads is None:
+            oh, ow = math.ceil(ih / self.sh), math.ceil(iw / self.sw)
+            pad_h = max((oh - 1) * self.sh + (self.kh - 1) * self.dh + 1 - ih, 0)
+            pad_w = max((ow - 1) * self.sw + (self.kw - 1) * self.dw + 1 - iw, 0)
+            pads = [int(pad_w // 2), int(pad_w - pad_w // 2), int(pad_h // 2), int(pad_h - pad_h // 2)]
+            self._pads[(ih, iw)] = pads
+        return pads
 
     def forward(self, x, weight):
         ih, iw = x.size()[-2:]
-        kh, kw = weight.size()[-2:]
-        oh, ow = math.ceil(ih / self.sh), math.ceil(iw / self.sw )
-        pad_h = max((oh - 1) * self.sh + (kh - 1) * self.dh + 1 - ih, 0)
-        pad_w = max((ow - 1) * self.sw + (kw - 1) * self.dw  + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            x = F.pad(x, [int(pad_w//2), int(pad_w - pad_w//2), int(pad_h//2), int(pad_h - pad_h//2)])
+        pads = self.padding(ih, iw)
+        if any(pads):
+            x = F.pad(x, pads)
+            # NOTE: F.pad of a 1x1 map comes back NCHW, hand the conv its own layout so it does not copy.
+            x = x.contiguous(memory_format=memory_format_of(weight))
         return x
         
 class Conv2dSamePadding(nn.Conv2d):
@@ -89,23 +103,65 @@ class Conv2dSamePadding(nn.Conv2d):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, groups=1, bias=True):
         super().__init__(in_channels, out_channels, kernel_size, stride, 0, dilation, groups, bias)
         self.stride = self.stride if len(self.stride) == 2 else [self.stride[0]]*2
-        self.pad2d = Pad2d(self.stride, self.dilation)
+        self.pad2d = Pad2d(self.stride, self.dilation, self.kernel_size)
 
     def forward(self, x):
+        ih, iw = x.size()[-2:]
+        left, right, top, bottom = self.pad2d.padding(ih, iw)
+        # NOTE: symmetric padding goes to the conv itself, so no padded copy of x is made. Not on the 1x1
+        # and 2x2 maps at the end of small images on CPU, where the depthwise kernels measured 1.5-3.4x
+        # slower with the conv's own padding than on a padded copy. Only measured on CPU, so cuda always folds.
+        small = ih <= 2 or iw <= 2
+        if left == right and top == bottom and not (small and x.device.type == 'cpu'):
+            return F.conv2d(x, self.weight, self.bias, self.stride, (top, left), self.dilation, self.groups)
         x = self.pad2d(x, self.weight)
         return F.conv2d(x, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
 
 
-
-def save_ckpt(logger, epoch, model, optimizer, ckpt_dir):
+def memory_format_of(x):
+    """ channels_last if x (an activation or a conv weight) is laid out NHWC, contiguous_format otherwise. """
+    # NOTE: read from the strides, is_contiguous() says yes to both on 1x1 maps and single channel weights.
+    if x.dim() != 4:
+        return torch.contiguous_format
+    if x.size(2) * x.size(3) > 1:
+        channels_last = x.stride(1) == 1
+    else:
+        channels_last = x.size(1) > 1 and x.stride(3) == x.size(1)
+    return torch.channels_last if channels_last else torch.contiguous_format
+
+
+def check_memory_format(model, input_size, memory_format=torch.channels_last, device='cpu'):
+    """
+    Runs one forward pass of a random input in memory_format and returns the names of the
+    modules whose 4D outputs are not laid out in memory_format anymore, i.e. where the
+    following ops silently work on (or copy to) another layout.
+    """
+    mismatched = []
+    def hook(name):
+        def check(module, inputs, output):
+            if isinstance(output, torch.Tensor) and output.dim() == 4 and not output.is_contiguous(memory_format=memory_format):
+                mismatched.append(name)
+        return check
+    handles = [module.register_forward_hook(hook(name)) for name, module in model.named_modules()]
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.rand(input_size, device=device).contiguous(memory_format=memory_format))
+    finally:
+        model.train(was_training)
+        for handle in handles:
+            handle.remove()
+    return mismatched
+
+
+
+def save_ckpt(logger, epoch, model, optimizer, ckpt_dir, keep=1):
+  """ Saves synchronously, see train_utils.checkpoint.CheckpointWriter to save in the background. """
   if ckpt_dir is None:
     return
   logger.info("saving ckpt: %d", epoch)
-  states = {'epoch': epoch, 'model_state_dict': model.state_dict(), 'optim_state_dict': optimizer.state_dict()}
-  ckpt_path = os.path.join(ckpt_dir, 'model_state_epoch.pth')
-  if os.path.exists(ckpt_path):
-      os.remove(ckpt_path)
-  torch.save(states, ckpt_path)
+  save_checkpoint(snapshot(epoch, model, optimizer), ckpt_dir, keep)
 
 
 ########################################################################
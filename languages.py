@@ -20,14 +20,17 @@ from allennlp.models import Model
 
 from allennlp.training.trainer import Trainer
 from allennlp.training.checkpointer import Checkpointer
+from train_utils.delta_checkpointer import DeltaCheckpointer
 
 from languages_data import pos_data_reader, embeddings_factory, iterators_factory, datasets_factory, preprocessing_factory
+from languages_data.synthetic_iterator import SyntheticIterator
 from language_models import models_factory, datareader_cfg_factory
 from languages_predictors import predictors_factory
 # distributed
 import torch.distributed as dist
 import torch.multiprocessing as mlproc
 from  train_utils.distributed_trainer import DistributeTrainer
+from train_utils.metrics_trainer import StepMetricsTrainer
 
 from ops_profiler.flop_counter import *
 
@@ -68,6 +71,9 @@ flags.DEFINE_integer('num_layers', 1, 'number of layers of recurrent models')
 flags.DEFINE_integer('max_sentence_length', 200, 'maxium length per sentence for the encoder')
 flags.DEFINE_bool('profile_only', False, 'Profile the model and exit.')
 flags.DEFINE_string('ckpt_dir', '/tmp/ckpt', 'the directory to load and save ckpt')
+flags.DEFINE_bool('delta_ckpt', False, 'ckpt only the chunks of the states that changed since the last full ckpt, see train_utils.delta_checkpointer')
+flags.DEFINE_string('step_metrics_file', None, 'if set, append one binary record per training step to this file, see train_utils.step_metrics')
+flags.DEFINE_bool('synthetic_data', False, 'train on the first batch of the dataset, kept on the device and fed again at every step, see languages_data.synthetic_iterator')
 
 
 
@@ -83,6 +89,7 @@ flags.DEFINE_string("dist_backend", None, "Which distributed backend to use, if
 #https://pytorch.org/tutorials/beginner/aws_distributed_training_tutorial.html
 flags.DEFINE_string("dist_method", None, "Which distributed method to use. e.g. starts with file://path/to/file, env://, tcp://IP:PORT. ")
 flags.DEFINE_integer("world_size", 1, "Number of distributed process. e.g. count all gpus in machines.")
+flags.DEFINE_integer("metrics_interval", 10, "Number of batches between two all_reduce of the training metrics, in between each rank logs its own.")
 
 
 flags.mark_flag_as_required('run_name')
@@ -160,6 +167,9 @@ def pre_init(program_flags, ngpus_per_node=None):
   batch_size = program_flags['batch_size']
   iterator = iterators_factory.get_iterator(program_flags['dataset'], batch_size)
   iterator.index_with(vocab)
+  if program_flags['synthetic_data']:
+    # NOTE: the device is set by the worker, once it is known.
+    iterator = SyntheticIterator(iterator)
   models_args = {
     'model_name': program_flags['model'],
     'embeddings': embeddings,
@@ -195,7 +205,10 @@ def distribute_worker(gpu_index, ngpus_per_node, world_size, program_flags):
   rank = program_flags['rank']
 
   ckpter = None
-  if rank == 0:
+  if program_flags['delta_ckpt']:
+    # NOTE: every rank restores from the delta ckpts, only the chief saves them.
+    ckpter = DeltaCheckpointer(serialization_dir=program_flags['ckpt_dir'], num_serialized_models_to_keep=2)
+  elif rank == 0:
     # only ever first rank do the ckpt to save time.
     ckpter = Checkpointer(serialization_dir=program_flags['ckpt_dir'], num_serialized_models_to_keep=2)
 
@@ -214,17 +227,30 @@ def distribute_worker(gpu_index, ngpus_per_node, world_size, program_flags):
   dist.init_process_group(backend=program_flags['dist_backend'], init_method=program_flags['dist_method'], world_size=world_size, rank=rank)
   
   logger.info("Rank %d --- preparing to start training", rank)
-# Set cuda to a single gpu context  
-  torch.cuda.set_device(gpu_index)
-  device = torch.device("cuda:%d" % gpu_index)
-  model.cuda(gpu_index)
-  model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[gpu_index])
-
-
+  if program_flags['dist_backend'] == 'gloo' and not program_flags['use_cuda']:
+    # NOTE: cpu training, num_gpus is then the number of processes per node.
+    cuda_device = -1
+    device = torch.device("cpu")
+    model = torch.nn.parallel.DistributedDataParallel(model)
+  else:
+    # Set cuda to a single gpu context  
+    cuda_device = gpu_index
+    torch.cuda.set_device(gpu_index)
+    device = torch.device("cuda:%d" % gpu_index)
+    model.cuda(gpu_index)
+    model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[gpu_index])
+  if program_flags['synthetic_data']:
+    iterator.cuda_device = cuda_device
+
+
+  step_metrics_file = program_flags['step_metrics_file']
+  if step_metrics_file is not None and rank > 0:
+    # NOTE: one file per rank, rank 0 keeps the given name.
+    step_metrics_file = step_metrics_file + '.%d' % rank
   trainer = DistributeTrainer(rank=rank, 
                               worldsize=world_size, 
                               ngpus_per_node=ngpus_per_node, 
-                              cuda_device=[gpu_index],
+                              cuda_device=[cuda_device],
                               model=model, 
                               optimizer=optimizer, 
                               iterator=iterator,
@@ -233,6 +259,8 @@ def distribute_worker(gpu_index, ngpus_per_node, world_size, program_flags):
                               serialization_dir=program_flags['ckpt_dir'],
                               checkpointer=ckpter,
                               log_batch_size_period=20,
+                              step_metrics_file=step_metrics_file,
+                              metrics_interval=program_flags['metrics_interval'],
                               )
                               
   logger.info(device)
@@ -252,10 +280,15 @@ def single_worker(logger, model, reader, out_feature_key, optimizer, iterator, t
     logger.warning("No cudart, probably means you do not have cuda on this machine.")
   model = model.to(device)
   cuda_device = 0 if FLAGS.use_cuda else -1 # TODO: multi GPU
+  if FLAGS.synthetic_data:
+    iterator.cuda_device = cuda_device
   # NOTE: THIS CKPT Mechanism only ckpt at the end of every epoch.
   # if an epoch is more than 1 day, then you take care of it yourself :P
-  ckpter = Checkpointer(serialization_dir=FLAGS.ckpt_dir, num_serialized_models_to_keep=1)
-  trainer = Trainer(model=model,
+  if FLAGS.delta_ckpt:
+    ckpter = DeltaCheckpointer(serialization_dir=FLAGS.ckpt_dir, num_serialized_models_to_keep=1)
+  else:
+    ckpter = Checkpointer(serialization_dir=FLAGS.ckpt_dir, num_serialized_models_to_keep=1)
+  trainer = StepMetricsTrainer(model=model,
                     optimizer=optimizer,
                     iterator=iterator,
                     train_dataset=train_dataset,
@@ -264,7 +297,8 @@ def single_worker(logger, model, reader, out_feature_key, optimizer, iterator, t
                     num_epochs=FLAGS.max_epochs,
                     checkpointer=ckpter,
                     log_batch_size_period = 10,
-                    cuda_device=cuda_device)
+                    cuda_device=cuda_device,
+                    step_metrics_file=FLAGS.step_metrics_file)
                     
   start_time = time.time()
   try:
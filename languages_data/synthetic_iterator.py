@@ -0,0 +1,31 @@
+from typing import Iterable
+from allennlp.data.instance import Instance
+from allennlp.nn import util as nn_util
+
+class SyntheticIterator(object):
+  """
+  Stands in for a DataIterator: the first batch the wrapped iterator builds is kept,
+  moved to cuda_device once, and handed out again at every step, for as many steps per
+  epoch as the wrapped iterator would take. The vocab and field layout come from the real
+  dataset, since the models are built from them, but no batching or indexing runs per step.
+  """
+  def __init__(self, iterator, cuda_device: int = -1) -> None:
+    self.iterator = iterator
+    self.cuda_device = cuda_device
+    self._batch = None
+
+  def index_with(self, vocab) -> None:
+    self.iterator.index_with(vocab)
+
+  def get_num_batches(self, instances: Iterable[Instance]) -> int:
+    return self.iterator.get_num_batches(instances)
+
+  def __call__(self, instances: Iterable[Instance], num_epochs: int = None, shuffle: bool = True):
+    if self._batch is None:
+      batch = next(iter(self.iterator(instances, num_epochs=1, shuffle=False)))
+      self._batch = nn_util.move_to_device(batch, self.cuda_device)
+    epoch = 0
+    while num_epochs is None or epoch < num_epochs:
+      for _ in range(self.get_num_batches(instances)):
+        yield self._batch
+      epoch += 1
@@ -1,6 +1,7 @@
 
 import os
 import signal
+import asyncio
 import time
 import subprocess
 import datetime
@@ -10,6 +11,9 @@ import system_tracker as sys_track
 import numpy as np
 import copy
 import models_to_run
+import experiment_ledger
+import step_stats
+from train_utils import step_metrics
 from models_def import *
 
 # NOTE: CNNs
@@ -70,26 +74,45 @@ models_train = {
     'pcie_mod_cmd': pcie_mod_cmd
 }
 
-def process(line):
-    # assuming always have sec/step
-    if 'sec/step' in line:
-        return line.split('(', 1)[1].split('sec')[0]
-    else:
-        return 0.0
-
-def get_average_num_step(file_path):
-    num = 0.0
-    mean = 0.0
-    with open(file_path, 'r') as f:
-        for line in f:
-            if 'sec/step' in line:
-                mean = mean * num
-                time_elapsed = process(line)
-                num += 1
-                mean = (mean + float(time_elapsed)) / num
-    return (num, mean)
-
-def create_process(batch_size, model_name, index, experiment_path, percent=0.0, is_nvprof=False, nvprof_args=None):
+def step_metrics_path(output_dir):
+    # NOTE: binary per step records written by the child, see train_utils.step_metrics
+    return os.path.join(output_dir, 'steps.bin')
+
+def load_step_stats(output_dir):
+    return step_stats.StepStats.load(step_metrics_path(output_dir))
+
+async def follow_steps(stats, p):
+    # NOTE: keeps the running sec/step numbers of a live job up to date in <log>.steps.json
+    while p.returncode is None:
+        if stats.update() > 0:
+            stats.save()
+        await asyncio.sleep(_STEP_POLL_INTERVAL)
+
+async def finish_steps(stats, follower, err_path):
+    follower.cancel()
+    stats.update()
+    stats.save()
+    if stats.num == 0:
+        # NOTE: children that do not write step records, fall back to their sec/step logs.
+        stats = step_stats.StepStats.load(err_path)
+        stats.update()
+        stats.save()
+    return stats
+
+def device_env(device):
+    # NOTE: pins a child to one gpu of the node, None keeps whatever the child picks.
+    if device is None:
+        return None
+    env = dict(os.environ)
+    env['CUDA_VISIBLE_DEVICES'] = str(device)
+    return env
+
+def monitor_prefix(experiment_run, device):
+    if device is None:
+        return str(experiment_run)
+    return str(experiment_run) + 'gpu' + str(device)
+
+async def create_process(batch_size, model_name, index, experiment_path, percent=0.0, is_nvprof=False, nvprof_args=None, device=None):
     execution_id = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')
     output_dir_name = execution_id+model_name+str(index)
     if is_nvprof:
@@ -112,6 +135,7 @@ def create_process(batch_size, model_name, index, experiment_path, percent=0.0,
     cmd = cmd + ['--dataset_dir', curr_dir]
     cmd = cmd + ['--run_name', output_dir_name]
     cmd = cmd + ['--batch_size', str(batch_size)]
+    cmd = cmd + ['--step_metrics_file', step_metrics_path(output_dir)]
     if _PROF_ONLY:
         cmd = cmd + ['--profile_only']
 
@@ -124,198 +148,401 @@ def create_process(batch_size, model_name, index, experiment_path, percent=0.0,
         cmd = nv_prefix + cmd
     
     print(cmd)
-    p = subprocess.Popen(cmd, stdout=out, stderr=err)
+    p = await asyncio.create_subprocess_exec(*cmd, stdout=out, stderr=err, env=device_env(device))
     return (p, out, err, err_out_file, output_dir)
 
-def kill_process_safe(pid, 
-                      err_handle, 
-                      out_handle, 
-                      path, 
-                      ids, 
-                      accumulated_models, 
-                      mean_num_models,
-                      mean_time_p_steps,
-                      processes_list,
-                      err_logs,
-                      out_logs,
-                      start_times,
-                      err_file_paths,
-                      i):
+def collect_process(err_handle, 
+                    out_handle, 
+                    stats, 
+                    model_index, 
+                    accumulated_models, 
+                    mean_num_models,
+                    mean_time_p_steps):
     err_handle.close()
     out_handle.close()
-    path_i = path
-    num, mean = get_average_num_step(path_i)
-    model_index = ids[pid]
+    num, mean = stats.num, stats.mean
     mean_num_models[model_index] = ((accumulated_models[model_index] * mean_num_models[model_index]) + num) / (accumulated_models[model_index] + 1.0)
     mean_time_p_steps[model_index] = ((accumulated_models[model_index] * mean_time_p_steps[model_index]) + mean) / (accumulated_models[model_index] + 1.0)
     accumulated_models[model_index] += 1.0
-    processes_list.pop(i)
-    err_logs.pop(i)
-    out_logs.pop(i)
-    start_times.pop(i)
-    err_file_paths.pop(i)
     return mean, num
-    
+
+def fold_stats(stats, attempt_stats):
+    # NOTE: adds the per model means of one attempt to the running means of the experiment set.
+    accumulated_models, mean_num_models, mean_time_p_steps = stats
+    attempt_models, attempt_num_models, attempt_time_p_steps = attempt_stats
+    for i in range(len(accumulated_models)):
+        total = accumulated_models[i] + attempt_models[i]
+        if total == 0:
+            continue
+        mean_num_models[i] = (accumulated_models[i] * mean_num_models[i] + attempt_models[i] * attempt_num_models[i]) / total
+        mean_time_p_steps[i] = (accumulated_models[i] * mean_time_p_steps[i] + attempt_models[i] * attempt_time_p_steps[i]) / total
+        accumulated_models[i] = total
+
+async def start_monitor(name, cmd, log_handle, device=None):
+    # NOTE: monitors share the event loop with the workers, we only get told when they exit.
+    try:
+        p = await asyncio.create_subprocess_exec(*cmd, stdout=log_handle, stderr=log_handle, env=device_env(device))
+    except FileNotFoundError:
+        # e.g. cpu only machines without pmon/pcie/nvidia-smi, keep the experiment going.
+        print('%s not found, not monitoring' % cmd[0])
+        return None
+    return p, asyncio.ensure_future(watch_monitor(name, p))
+
+async def watch_monitor(name, p):
+    returncode = await p.wait()
+    print('%s Process %d exited with %d' % (name, p.pid, returncode))
+
+async def stop_monitor(p, watcher):
+    watcher.cancel()
+    if p.returncode is None:
+        p.kill()
+    await p.wait()
+
+async def wait_until_ready(p, path, steps_path=None, min_delay=None, max_delay=None):
+    """
+    Waits until the child p has logged one of _READY_MARKERS in path (its err.log, where
+    the training loggers write) or written its first record to steps_path (its steps.bin),
+    bounded by min_delay and max_delay. Returns the seconds waited.
+    """
+    min_delay = _STAGGER_MIN_DELAY if min_delay is None else min_delay
+    max_delay = _STAGGER_MAX_DELAY if max_delay is None else max_delay
+    start_time = time.time()
+    offset = 0
+    partial = b''
+    ready = False
+    while not ready and p.returncode is None and time.time() - start_time < max_delay:
+        await asyncio.sleep(_READY_POLL_INTERVAL)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read()
+        offset += len(chunk)
+        # keep the unfinished line around, the marker may be split across reads.
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop()
+        ready = any(marker in line for line in lines for marker in _READY_MARKERS)
+        # NOTE: every child writes steps.bin, also the allennlp trainers that log no marker.
+        ready = ready or (steps_path is not None and os.path.exists(steps_path)
+                          and os.path.getsize(steps_path) >= step_metrics.RECORD_SIZE)
+    waited = time.time() - start_time
+    if waited < min_delay:
+        await asyncio.sleep(min_delay - waited)
+        waited = min_delay
+    print('Process %d %s after %.2f secs' % (p.pid, 'ready' if ready else 'not ready', waited))
+    return waited
+
+async def start_pmon(experiment_path, experiment_run, monitors, handles, device=None):
+    prefix = monitor_prefix(experiment_run, device)
+    pmon_log_path = os.path.join(experiment_path, prefix+'pmon.log')
+    pmon_log = open(pmon_log_path, 'a+')
+    handles.append(pmon_log)
+    pmon_csv = os.path.join(experiment_path, prefix+'pmon.csv')
+    pmon_cmd = copy.deepcopy(models_train['pmon_mod_cmd'])
+    pmon_cmd += ['--logpath='+pmon_csv]
+    monitors.append(await start_monitor('PMON', pmon_cmd, pmon_log, device))
+
+async def start_gpu_monitors(experiment_path, experiment_run, monitors, handles, device=None):
+    prefix = monitor_prefix(experiment_run, device)
+    pcie_log_path = os.path.join(experiment_path, prefix+'pcie.log')
+    pcie_log = open(pcie_log_path, 'a+')
+    handles.append(pcie_log)
+    pcie_csv = os.path.join(experiment_path, prefix+'pcie.csv')
+    pcie_cmd = copy.deepcopy(models_train['pcie_mod_cmd'])
+    pcie_cmd += [ '--logpath='+pcie_csv ]
+    monitors.append(await start_monitor('PCIe mon', pcie_cmd, pcie_log, device))
+
+    smi_file_path = os.path.join(experiment_path, prefix+'smi_out.log') 
+    smi_file = open(smi_file_path, 'a+')
+    handles.append(smi_file)
+    nvidia_csv = "smi_watch.csv"
+    nvidia_csv = prefix+nvidia_csv
+    smi_query = ['--query-gpu=memory.used,memory.total,utilization.gpu,utilization.memory,power.draw']
+    if device is not None:
+        smi_query += ['--id='+str(device)]
+    nvidia_smi_cmd = ['watch', '-n', '0.2', 'nvidia-smi'] + smi_query + [
+                    '--format=noheader,csv', '|', 'tee', '-a' , experiment_path+'/'+nvidia_csv]
+    monitors.append(await start_monitor('NVIDIA_SMI', nvidia_smi_cmd, smi_file))
+
+async def stop_all(workers, watchers, monitors, handles):
+    for watcher in watchers:
+        watcher.cancel()
+    for p, out, err in workers:
+        if p.returncode is None:
+            p.kill()
+            await p.wait()
+            print('%d killed ! ! !' % p.pid)
+        err.close()
+        out.close()
+    for monitor in monitors:
+        if monitor is not None:
+            await stop_monitor(*monitor)
+    for handle in handles:
+        handle.close()
+
+async def watch_worker(p, err, out, path, out_dir, model_index, stats, average_file, experiment_index, experiment_run):
+    # wakes up as soon as the child exits, no polling interval involved.
+    steps = load_step_stats(out_dir)
+    follower = asyncio.ensure_future(follow_steps(steps, p))
+    try:
+        returncode = await p.wait()
+    finally:
+        steps = await finish_steps(steps, follower, path)
+    accumulated_models, mean_num_models, mean_time_p_steps = stats
+    mean, num = collect_process(err, out, steps, model_index, accumulated_models, mean_num_models, mean_time_p_steps)
+    print('Process %d exited with %d, sec/step p50 %.4f p99 %.4f' % (p.pid, returncode, steps.percentile(50), steps.percentile(99)))
+    if not _PROF_ONLY:
+        line = ("experiment set %d, experiment_run %d: %d process average num p step is %.4f and total number of step is: %d \n" % 
+                (experiment_index, experiment_run, p.pid, mean, num))
+        average_file.write(line)
+        average_file.flush()
+    return returncode
+
 _RUNS_PER_SET = 1
 _START = 1
 _RUN_NVPROF = False
 _PROF_ONLY = False 
+# NOTE: a new model is launched once the previous one logged its first step (see _READY_MARKERS)
+# or wrote it to its steps.bin, but never before _STAGGER_MIN_DELAY and never after _STAGGER_MAX_DELAY seconds.
+_STAGGER_MIN_DELAY = 2
+_STAGGER_MAX_DELAY = 20
+_READY_POLL_INTERVAL = 0.2
+_READY_MARKERS = (b'sec/step', b'First step of this epoch')
+# NOTE: how often the sec/step numbers of running jobs are brought up to date.
+_STEP_POLL_INTERVAL = 1
+# NOTE: gpu ids of the node, if set, main() runs independent sets at the same time, one set per gpu.
+_DEVICES = []
+# NOTE: if > 0, main() runs models_to_run.queue in backfill mode keeping this many models on the gpu.
+_BACKFILL_SLOTS = 0
 
-def run(
+async def run_experiment(
+    batch_size,
+    average_file, experiment_path,
+    experiment_set, total_length,
+    experiment_index, experiment_run,
+    stats, device=None):
+    workers = []
+    watchers = []
+    monitors = []
+    handles = []
+    sys_tracker = None
+    try:
+        await start_pmon(experiment_path, experiment_run, monitors, handles, device)
+
+        percent = (1 / len(experiment_set)) - 0.075 # some overhead of cuda stuff i think :/
+        for i, m in enumerate(experiment_set):
+            if i > 0:
+                await wait_until_ready(p, path, step_metrics_path(out_dir))
+            p, out, err, path, out_dir = await create_process(batch_size, m, i, experiment_path, percent, device=device)
+            workers.append((p, out, err))
+            watchers.append(asyncio.ensure_future(
+                watch_worker(p, err, out, path, out_dir, i, stats, average_file, experiment_index, experiment_run)))
+
+        if not _PROF_ONLY:
+            sys_tracker = sys_track.InfosTracker(experiment_path)
+            await start_gpu_monitors(experiment_path, experiment_run, monitors, handles, device)
+            sys_tracker.start()
+
+        returncodes = await asyncio.gather(*watchers)
+        print('total experiments: %d, experiment_run %d , finished %d' % (total_length-1, experiment_run, experiment_index))
+        return returncodes
+    finally:
+        print("final")
+        await stop_all(workers, watchers, monitors, handles)
+        if sys_tracker is not None:
+            sys_tracker.stop()
+
+async def run_async(
     batch_size,
     average_log, experiment_path, 
     experiment_set, total_length, 
     experiment_index,
-    nvprofiling=False):
-    
+    nvprofiling=False,
+    device=None,
+    ledger=None,
+    runs=None):
+    """
+    Runs experiment_set for every run index in runs (defaults to all _RUNS_PER_SET of them).
+    With a ledger, cells it has as completed are skipped and failed ones are retried up to
+    its cap. Returns the status of every attempted run index.
+    """
     if not os.path.exists(experiment_path):
         os.makedirs(experiment_path)
 
     mean_num_models = np.zeros(len(experiment_set), dtype=float)
     mean_time_p_steps = np.zeros(len(experiment_set), dtype=float)
     accumulated_models = np.zeros(len(experiment_set), dtype=float)
+    stats = (accumulated_models, mean_num_models, mean_time_p_steps)
 
     is_single = len(experiment_set) == 1
 
     if is_single and nvprofiling:
         # 1. we want to use nvprof three times at least, make sure the metrics are correct
         for metric_run in range(3):
-          nvp, out, err, path, out_dir = create_process(experiment_set[0], 1, experiment_path, 0.92, True, 
+          nvp, out, err, path, out_dir = await create_process(batch_size, experiment_set[0], metric_run, experiment_path, 0.92, True, 
               ['--timeout', str(60*7),
-               '--metrics', 'achieved_occupancy,ipc,sm_efficiency,dram_utilization,sysmem_utilization,flop_dp_efficiency,flop_sp_efficiency',])
-          while nvp.poll() is None:
-              print("nvprof profiling metrics %s" % experiment_set[0])
-              time.sleep(2)
+               '--metrics', 'achieved_occupancy,ipc,sm_efficiency,dram_utilization,sysmem_utilization,flop_dp_efficiency,flop_sp_efficiency',],
+              device=device)
+          print("nvprof profiling metrics %s" % experiment_set[0])
+          await nvp.wait()
           out.close()
           err.close()
 
-    for experiment_run in range(_START, _RUNS_PER_SET+_START):
-        if not _PROF_ONLY:
-            if os.path.exists(average_log):
+    if runs is None:
+        runs = range(_START, _RUNS_PER_SET+_START)
+    statuses = {}
+    for experiment_run in runs:
+        key = experiment_ledger.cell_key(experiment_index, batch_size, experiment_run)
+        while ledger is None or ledger.should_run(key):
+            if ledger is not None:
+                ledger.record(key, experiment_ledger.STARTED, models=experiment_set)
+            average_file = None
+            if not _PROF_ONLY:
                 average_file = open(average_log, mode='a+')
-            else:
-                average_file = open(average_log, mode='w+')
-        processes_list = []
-        err_logs = []
-        out_logs = []
-        out_file_paths = []
-        start_times = []
-        ids = {}
-        pmon_log_path = os.path.join(experiment_path, str(experiment_run)+'pmon.log')
-        pmon_log = open(pmon_log_path, 'a+')
-        pmon_csv = os.path.join(experiment_path, str(experiment_run)+'pmon.csv')
-        pmon_cmd = copy.deepcopy(models_train['pmon_mod_cmd'])
-        pmon_cmd += ['--logpath='+pmon_csv]
-        pmon_p = subprocess.Popen(pmon_cmd, stdout=pmon_log, stderr=pmon_log)
-        pmon_poll = None
-        percent = (1 / len(experiment_set)) - 0.075 # some overhead of cuda stuff i think :/
-        for i, m in enumerate(experiment_set):
-            if i > 0:
-              time.sleep(20)
-            start_time = time.time()
-            p, out, err, path, out_dir = create_process(batch_size, m, i, experiment_path, percent)
-            processes_list.append(p)
-            err_logs.append(err)
-            out_logs.append(out)
-            start_times.append(start_time)
-            out_file_paths.append(path)
-            ids[p.pid] = i
-        should_stop = False
-        if not _PROF_ONLY:
-            sys_tracker = sys_track.InfosTracker(experiment_path)
+            # NOTE: only completed attempts go into the TOTAL lines, retries of a failed run start over.
+            attempt_stats = tuple(np.zeros(len(experiment_set), dtype=float) for _ in range(3))
+            try:
+                returncodes = await run_experiment(batch_size, average_file, experiment_path, experiment_set, total_length,
+                                                   experiment_index, experiment_run, attempt_stats, device)
+            finally:
+                if average_file is not None:
+                    average_file.close()
+            failed = any(returncode != 0 for returncode in returncodes)
+            if not failed:
+                fold_stats(stats, attempt_stats)
+            statuses[experiment_run] = experiment_ledger.FAILED if failed else experiment_ledger.COMPLETED
+            if ledger is None:
+                break
+            ledger.record(key, statuses[experiment_run], returncodes=returncodes)
+        if experiment_run not in statuses:
+            print('skipping experiment set %d, experiment_run %d: %s in ledger' % (experiment_index, experiment_run, ledger.status(key)))
+    if not _PROF_ONLY and len(statuses) > 0:
+        # Experiment average size.
+        average_file = open(average_log, mode='a+')
+        for i in range(len(experiment_set)):
+            average_file.write("TOTAL: In experiment %d average mean sec/step and average number for model %d are %.4f , %d \n" % 
+                            (experiment_index, i, mean_time_p_steps[i], mean_num_models[i]))
+        average_file.close()
+    return statuses
+
+def run(
+    batch_size,
+    average_log, experiment_path, 
+    experiment_set, total_length, 
+    experiment_index,
+    nvprofiling=False,
+    ledger=None,
+    runs=None):
+    # NOTE: one event loop drives workers and monitors, child exits are picked up immediately.
+    try:
+        return asyncio.run(run_async(batch_size, average_log, experiment_path, experiment_set,
+                                     total_length, experiment_index, nvprofiling, ledger=ledger, runs=runs))
+    except KeyboardInterrupt:
+        print("done")
+    
+async def run_on_devices_async(batch_size, average_log, experiment_path, sets, devices, nvprofiling=False, ledger=None):
+    """
+    Device pool scheduler: every set runs through run_async() pinned to one free device
+    (CUDA_VISIBLE_DEVICES) with its own monitors, sets are picked up as devices free up.
+    """
+    free_devices = asyncio.Queue()
+    for device in devices:
+        free_devices.put_nowait(device)
 
+    async def run_set(experiment_index, ex):
+        device = await free_devices.get()
         try:
-            if not _PROF_ONLY:
-                
-
-                pcie_log_path = os.path.join(experiment_path, str(experiment_run)+'pcie.log')
-                pcie_log = open(pcie_log_path, 'a+')
-                pcie_csv = os.path.join(experiment_path, str(experiment_run)+'pcie.csv')
-                pcie_cmd = copy.deepcopy(models_train['pcie_mod_cmd'])
-                pcie_cmd += [ '--logpath='+pcie_csv ]
-                pcie_p = subprocess.Popen(pcie_cmd, stdout=pcie_log, stderr=pcie_log)
-                pcie_poll = None
-
-                smi_file_path = os.path.join(experiment_path, str(experiment_run)+'smi_out.log') 
-                smi_file = open(smi_file_path, 'a+')
-                nvidia_csv = "smi_watch.csv"
-                nvidia_csv = str(experiment_run)+nvidia_csv
-                nvidia_smi_cmd = ['watch', '-n', '0.2', 'nvidia-smi', 
-                                '--query-gpu=memory.used,memory.total,utilization.gpu,utilization.memory,power.draw', 
-                                '--format=noheader,csv', '|', 'tee', '-a' , experiment_path+'/'+nvidia_csv]
-                smi_p = subprocess.Popen(nvidia_smi_cmd, stdout=smi_file, stderr=smi_file)
-                smi_poll = None
-                sys_tracker.start()
-            while not should_stop:
-                time.sleep(5)
-                if len(processes_list) <= 0:
-                    should_stop = True
-
-                for i,(p, err, out, start_time, path) in enumerate(zip(processes_list, err_logs, out_logs, start_times, out_file_paths)):
-                    poll = None
-                    pid = p.pid
-                    poll = p.poll()
-                    current_time = time.time()
-                    executed = current_time - start_time
-                    if poll is None:
-                        print('Process %d still running' % pid)
-                    else:
-                        mean, num = kill_process_safe(pid, err, out, path, ids, accumulated_models, 
-                                                    mean_num_models, mean_time_p_steps, processes_list, err_logs, out_logs, start_times, out_file_paths, i)
-                        if not _PROF_ONLY:
-                            line = ("experiment set %d, experiment_run %d: %d process average num p step is %.4f and total number of step is: %d \n" % 
-                                    (experiment_index, experiment_run, pid, mean, num))
-                            average_file.write(line)
+            print('experiment set %d running on device %s' % (experiment_index, device))
+            current_experiment_path = os.path.join(experiment_path, str(experiment_index))
+            set_log = average_log
+            if nvprofiling:
+                current_experiment_path = os.path.join(current_experiment_path, "timeline_metrics")
+                set_log = os.path.join(current_experiment_path, 'experiment.log')
+            await run_async(batch_size, set_log, current_experiment_path, ex, len(sets),
+                            experiment_index, nvprofiling, device, ledger)
+        finally:
+            free_devices.put_nowait(device)
 
-                if not _PROF_ONLY:
-                    smi_poll = smi_p.poll()
-                    if smi_poll is None:
-                        print('NVIDIA_SMI Process %d still running' % smi_p.pid)
-                    
-                    pcie_poll = pcie_p.poll()
-                    if pcie_poll is None:
-                        print('PCIe mon Process %d still running' % pcie_p.pid)
+    await asyncio.gather(*[run_set(i, ex) for i, ex in enumerate(sets)])
 
+def run_on_devices(batch_size, average_log, experiment_path, sets, devices, nvprofiling=False, ledger=None):
+    try:
+        asyncio.run(run_on_devices_async(batch_size, average_log, experiment_path, sets, devices, nvprofiling, ledger))
+    except KeyboardInterrupt:
+        print("done")
 
-                pmon_poll = pmon_p.poll()
-                if pmon_poll is None:
-                    print('PMON Process %d still running' % pmon_p.pid)
+def job_label(index, model_name):
+    return '%d:%s' % (index, model_name)
 
-            print('total experiments: %d, experiment_run %d , finished %d' % (total_length-1, experiment_run, experiment_index))
+async def run_backfill_async(batch_size, average_log, experiment_path, queue, slots):
+    """
+    Work conserving version of run(): keeps `slots` models resident and starts the
+    next pending model of `queue` as soon as one exits. Every job is tagged with all
+    the models it shared the gpu with over its lifetime.
+    """
+    if not os.path.exists(experiment_path):
+        os.makedirs(experiment_path)
 
-        except KeyboardInterrupt:
-            if not _PROF_ONLY:
-                smi_p.kill()
-                smi_file.close()
-                for p, err, out in zip(processes_list, err_logs, out_logs):
-                    pid = p.pid
-                    p.kill()
-                    err.close()
-                    out.close()
-                    print('%d killed ! ! !' % pid)
-            else:
-                print("done")
-        finally:
-            print("final")
-            pmon_p.kill()
-            pmon_log.close()
-            if not _PROF_ONLY:
-                smi_poll = smi_p.poll()
-                pcie_p.kill()
-                pcie_log.close()
-                if smi_poll is None:
-                    smi_p.kill()
-                    smi_file.close()
+    experiment_run = _START
+    pending = list(enumerate(queue))
+    running = {}
+    workers = []
+    monitors = []
+    handles = []
+    sys_tracker = None
+    average_file = None
+    try:
         if not _PROF_ONLY:
-            average_file.close()
+            average_file = open(average_log, mode='a+')
+        await start_pmon(experiment_path, experiment_run, monitors, handles)
+        if not _PROF_ONLY:
+            sys_tracker = sys_track.InfosTracker(experiment_path)
+            await start_gpu_monitors(experiment_path, experiment_run, monitors, handles)
+            sys_tracker.start()
+
+        percent = (1 / slots) - 0.075
+        filling = True
+        while pending or running:
+            while pending and len(running) < slots:
+                if filling and running:
+                    await wait_until_ready(p, path, step_metrics_path(out_dir))
+                index, m = pending.pop(0)
+                p, out, err, path, out_dir = await create_process(batch_size, m, index, experiment_path, percent)
+                workers.append((p, out, err))
+                steps = load_step_stats(out_dir)
+                job = {'index': index, 'model': m, 'p': p, 'out': out, 'err': err, 'path': path, 'corunners': set(),
+                       'steps': steps, 'follower': asyncio.ensure_future(follow_steps(steps, p))}
+                for other in running.values():
+                    other['corunners'].add(job_label(index, m))
+                    job['corunners'].add(job_label(other['index'], other['model']))
+                running[asyncio.ensure_future(p.wait())] = job
+            filling = False
+
+            done, _ = await asyncio.wait(list(running.keys()), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                job = running.pop(task)
+                job['err'].close()
+                job['out'].close()
+                steps = await finish_steps(job['steps'], job['follower'], job['path'])
+                num, mean = steps.num, steps.mean
+                print('Process %d exited with %d' % (job['p'].pid, job['p'].returncode))
+                if not _PROF_ONLY:
+                    line = ("backfill job %s, experiment_run %d: %d process average num p step is %.4f and total number of step is: %d, co-runners: %s \n" %
+                            (job_label(job['index'], job['model']), experiment_run, job['p'].pid, mean, num, ','.join(sorted(job['corunners']))))
+                    average_file.write(line)
+                    average_file.flush()
+        print('backfill finished %d models with %d slots' % (len(queue), slots))
+    finally:
+        print("final")
+        await stop_all(workers, [], monitors, handles)
+        if sys_tracker is not None:
             sys_tracker.stop()
-    if not _PROF_ONLY:
-        # Experiment average size.
-        average_file = open(average_log, mode='a+')
-        for i in range(len(experiment_set)):
-            average_file.write("TOTAL: In experiment %d average mean sec/step and average number for model %d are %.4f , %d \n" % 
-                            (experiment_index, i, mean_time_p_steps[i], mean_num_models[i]))
-        average_file.close()
+        if average_file is not None:
+            average_file.close()
+
+def run_backfill(batch_size, average_log, experiment_path, queue, slots):
+    try:
+        asyncio.run(run_backfill_async(batch_size, average_log, experiment_path, queue, slots))
+    except KeyboardInterrupt:
+        print("done")
     
 def main():
     # which one we should run in parallel
@@ -330,18 +557,28 @@ def main():
     for b in _default_batch_size:
         experiment_path = os.path.join(project_dir, 'experiment')
         experiment_path = experiment_path+str(b)
-        for experiment_index, ex in enumerate(sets):
-            current_experiment_path = os.path.join(experiment_path, str(experiment_index))
-            experiment_file = os.path.join(experiment_path, 'experiment.log')
+        # NOTE: completed cells are skipped when the sweep is restarted, see experiment_ledger.
+        ledger = experiment_ledger.Ledger(os.path.join(experiment_path, 'ledger.jsonl'))
+        if _BACKFILL_SLOTS > 0:
+            queue = copy.deepcopy(models_to_run.queue)
+            run_backfill(b, os.path.join(experiment_path, 'experiment.log'),
+                         os.path.join(experiment_path, 'backfill'), queue, _BACKFILL_SLOTS)
+        elif len(_DEVICES) > 0:
+            run_on_devices(b, os.path.join(experiment_path, 'experiment.log'), experiment_path,
+                           sets, _DEVICES, _RUN_NVPROF, ledger)
+        else:
+            for experiment_index, ex in enumerate(sets):
+                current_experiment_path = os.path.join(experiment_path, str(experiment_index))
+                experiment_file = os.path.join(experiment_path, 'experiment.log')
 
-            if _RUN_NVPROF:
-                # TODO: transition and test with nsight
-                # NOTE: timeline please use nsight-system gui to do so. much better.
-                current_experiment_path = os.path.join(current_experiment_path, "timeline_metrics")
-                profiled_log = os.path.join(current_experiment_path, 'experiment.log')
-                run(b, profiled_log, current_experiment_path, ex, len(sets), experiment_index, _RUN_NVPROF)
-            else:
-                run(b, experiment_file, current_experiment_path, ex, len(sets), experiment_index)
+                if _RUN_NVPROF:
+                    # TODO: transition and test with nsight
+                    # NOTE: timeline please use nsight-system gui to do so. much better.
+                    current_experiment_path = os.path.join(current_experiment_path, "timeline_metrics")
+                    profiled_log = os.path.join(current_experiment_path, 'experiment.log')
+                    run(b, profiled_log, current_experiment_path, ex, len(sets), experiment_index, _RUN_NVPROF, ledger)
+                else:
+                    run(b, experiment_file, current_experiment_path, ex, len(sets), experiment_index, ledger=ledger)
 
         if not _PROF_ONLY:
             app_csv_p = subprocess.Popen(['python', 'multiprocess_appfinishtime.py'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -1,3 +1,7 @@
 sets = [
   ["mnasnet1_3_cmd", "vgg19_cmd"]
 ]
+
+# NOTE: used by the backfill mode (_BACKFILL_SLOTS in model_interference_test.py),
+# models are started in this order whenever a slot on the gpu frees up.
+queue = [m for s in sets for m in s]
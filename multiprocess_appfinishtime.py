@@ -31,8 +31,9 @@ def get_app_finish_time(output_log):
     'efficientnetb3_cmd'
     ]
 
-  set_num = int(os.path.basename(os.path.dirname(os.path.dirname(output_log))))
-  run_name = dict_sets[set_num]
+  set_dir = os.path.basename(os.path.dirname(os.path.dirname(output_log)))
+  # NOTE: backfill runs are not bound to a set, keep the directory name instead.
+  run_name = dict_sets[int(set_dir)] if set_dir.isdigit() else set_dir
   with open(output_log, 'r', encoding='utf8') as outlog_f:
     for line in outlog_f:
       if "Finished" in line and "training" not in line:
@@ -55,7 +56,7 @@ def main():
   for dir_path, subdirs, filenames in os.walk(project_dir):
     for fn in filenames:
       if "nvprof" in dir_path: continue
-      if "err.log" in fn and "-timeline" not in fn:
+      if fn.endswith("err.log") and "-timeline" not in fn:
         app_output_log = os.path.join(dir_path, fn)
         app_output_logs.append(app_output_log)
   start_time = time.time()
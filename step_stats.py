@@ -0,0 +1,118 @@
+"""
+Incremental sec/step statistics of a training log.
+
+StepStats tails a log file from a saved byte offset and keeps a running count, mean,
+variance (Welford), min/max and a fixed size reservoir for percentiles, so following a
+job while it runs costs only the new bytes and the final numbers are available in O(1).
+Its state can be saved next to the log and picked up again after a restart.
+Files ending in .bin are read as train_utils.step_metrics records instead of text.
+"""
+import os
+import json
+import random
+from train_utils import step_metrics
+
+_RESERVOIR_SIZE = 4096
+_STEP_MARKER = b'sec/step'
+
+
+def parse_step_time(line):
+    # NOTE: same format as the "(%.4f sec/step)" logs of image_classifier and languages.
+    return float(line.split(b'(', 1)[1].split(b'sec', 1)[0])
+
+
+class StepStats(object):
+    """Running sec/step statistics of one log file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.binary = path.endswith('.bin')
+        self.offset = 0
+        self.num = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.reservoir = []
+        self._partial = b''
+        self._random = random.Random(0)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.num - 1) if self.num > 1 else 0.0
+
+    def percentile(self, q):
+        if len(self.reservoir) == 0:
+            return 0.0
+        ordered = sorted(self.reservoir)
+        return ordered[min(int(q / 100.0 * len(ordered)), len(ordered) - 1)]
+
+    def add(self, step_time):
+        self.num += 1
+        delta = step_time - self.mean
+        self.mean += delta / self.num
+        self.m2 += delta * (step_time - self.mean)
+        self.min = step_time if self.min is None else min(self.min, step_time)
+        self.max = step_time if self.max is None else max(self.max, step_time)
+        if len(self.reservoir) < _RESERVOIR_SIZE:
+            self.reservoir.append(step_time)
+        else:
+            slot = self._random.randrange(self.num)
+            if slot < _RESERVOIR_SIZE:
+                self.reservoir[slot] = step_time
+
+    def update(self):
+        """Consumes whatever was appended to the log since the last call, returns the new steps."""
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        self.offset += len(chunk)
+        data = self._partial + chunk
+        before = self.num
+        if self.binary:
+            for step, wall_time, step_time, loss, batch_size in step_metrics.iter_records(data):
+                self.add(step_time)
+            self._partial = data[len(data) - len(data) % step_metrics.RECORD_SIZE:]
+            return self.num - before
+        lines = data.split(b'\n')
+        # NOTE: the last piece is an unfinished line, it is completed by the next read.
+        self._partial = lines.pop()
+        for line in lines:
+            if _STEP_MARKER in line:
+                try:
+                    self.add(parse_step_time(line))
+                except (IndexError, ValueError):
+                    continue
+        return self.num - before
+
+    def state_path(self):
+        return self.path + '.steps.json'
+
+    def save(self):
+        state = {
+            'offset': self.offset - len(self._partial),
+            'num': self.num, 'mean': self.mean, 'm2': self.m2,
+            'min': self.min, 'max': self.max, 'reservoir': self.reservoir,
+        }
+        tmp_path = self.state_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path())
+
+    @classmethod
+    def load(cls, path):
+        """Resumes from the saved state next to path if there is one."""
+        stats = cls(path)
+        if os.path.exists(stats.state_path()):
+            with open(stats.state_path(), 'r') as f:
+                state = json.load(f)
+            for k in ['offset', 'num', 'mean', 'm2', 'min', 'max', 'reservoir']:
+                setattr(stats, k, state[k])
+        return stats
+
+    def summary(self):
+        return {'num': self.num, 'mean': self.mean, 'variance': self.variance,
+                'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
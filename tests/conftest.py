@@ -0,0 +1,5 @@
+import os
+import sys
+
+# NOTE: the modules under test are scripts and packages of the repo root, which is not installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
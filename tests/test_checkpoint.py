@@ -0,0 +1,28 @@
+import pytest
+import torch
+import torchvision.models as models
+from train_utils.checkpoint import CheckpointWriter, load_latest_checkpoint, restore_checkpoint
+
+
+def _model_and_optimizer():
+  model = models.mnasnet0_5(num_classes=10)
+  optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+  model(torch.rand(2, 3, 32, 32)).sum().backward()
+  optimizer.step()
+  return model, optimizer
+
+
+@pytest.mark.parametrize('ckpt_format', ['torch', 'flat'])
+def test_resume_keeps_state_dict_versions(tmp_path, ckpt_format):
+  # NOTE: MNASNet checks the version of its state_dict in load_state_dict.
+  model, optimizer = _model_and_optimizer()
+  writer = CheckpointWriter(str(tmp_path), keep=2, ckpt_format=ckpt_format)
+  writer.save(3, model, optimizer)
+  writer.close()
+
+  restored = models.mnasnet0_5(num_classes=10)
+  restored_optimizer = torch.optim.SGD(restored.parameters(), lr=0.1, momentum=0.9)
+  _, states = load_latest_checkpoint(str(tmp_path))
+  assert restore_checkpoint(states, restored, restored_optimizer) == 3
+  for name, tensor in model.state_dict().items():
+    assert torch.equal(tensor, restored.state_dict()[name])
@@ -0,0 +1,80 @@
+import os
+import pytest
+import torch
+
+pytest.importorskip('allennlp')
+
+import torch.distributed as dist
+import torch.multiprocessing as mlproc
+from allennlp.data import Instance, Vocabulary
+from allennlp.data.fields import SequenceLabelField, TextField
+from allennlp.data.iterators import BasicIterator
+from allennlp.data.token_indexers import SingleIdTokenIndexer
+from allennlp.data.tokenizers import Token
+from allennlp.models import Model
+from allennlp.nn.util import get_text_field_mask, sequence_cross_entropy_with_logits
+from train_utils.distributed_trainer import DistributeTrainer
+
+NUM_INSTANCES = 22
+BATCH_SIZE = 4
+NUM_EPOCHS = 2
+WORLD_SIZE = 2
+
+
+class CountingTagger(Model):
+  """Tags every token, counts its forward passes."""
+  def __init__(self, vocab):
+    super().__init__(vocab)
+    self.embedding = torch.nn.Embedding(vocab.get_vocab_size('tokens'), 8)
+    self.projection = torch.nn.Linear(8, vocab.get_vocab_size('labels'))
+    self.forwards = 0
+
+  def forward(self, tokens, tags):
+    self.forwards += 1
+    mask = get_text_field_mask(tokens)
+    logits = self.projection(self.embedding(tokens['tokens']))
+    return {'loss': sequence_cross_entropy_with_logits(logits, tags, mask)}
+
+
+def _instances():
+  indexers = {'tokens': SingleIdTokenIndexer()}
+  words, tags = ['the', 'cat', 'sat'], ['D', 'N', 'V']
+  instances = []
+  for i in range(NUM_INSTANCES):
+    length = 1 + i % len(words)
+    tokens = TextField([Token(word) for word in words[:length]], indexers)
+    instances.append(Instance({'tokens': tokens, 'tags': SequenceLabelField(tags[:length], tokens)}))
+  return instances
+
+
+def _train(rank, init_file, serialization_dir):
+  dist.init_process_group('gloo', init_method='file://' + init_file, world_size=WORLD_SIZE, rank=rank)
+  instances = _instances()
+  vocab = Vocabulary.from_instances(instances)
+  iterator = BasicIterator(batch_size=BATCH_SIZE)
+  iterator.index_with(vocab)
+  model = CountingTagger(vocab)
+  trainer = DistributeTrainer(rank=rank,
+                              worldsize=WORLD_SIZE,
+                              ngpus_per_node=WORLD_SIZE,
+                              cuda_device=[-1],
+                              model=torch.nn.parallel.DistributedDataParallel(model),
+                              optimizer=torch.optim.SGD(model.parameters(), lr=0.1),
+                              iterator=iterator,
+                              train_dataset=instances,
+                              num_epochs=NUM_EPOCHS,
+                              serialization_dir=serialization_dir,
+                              metrics_interval=2)
+  metrics = trainer.train()
+  num_batches = iterator.get_num_batches(instances)
+  assert num_batches > 1
+  assert model.forwards == NUM_EPOCHS * num_batches
+  if rank == 0:
+    # NOTE: only the chief puts together the metrics of train().
+    assert metrics['training_samples_per_sec'] > 0
+    assert metrics['training_tokens_per_sec'] > 0
+  dist.destroy_process_group()
+
+
+def test_epoch_runs_every_batch_on_gloo(tmp_path):
+  mlproc.spawn(_train, args=(str(tmp_path / 'init'), str(tmp_path / 'ckpt')), nprocs=WORLD_SIZE)
@@ -0,0 +1,57 @@
+import os
+import sys
+import glob
+import asyncio
+import pytest
+
+pytest.importorskip('psutil')
+
+import model_interference_test as mit
+
+DEVICES = ['0', '1']
+# NOTE: ignores the training flags it is given, logs its device and when it held it.
+STUB = ("import os, sys, time; start = time.time(); time.sleep(0.5); "
+        "print(os.environ.get('CUDA_VISIBLE_DEVICES'), start, time.time())")
+
+
+async def _no_monitors(*args, **kwargs):
+  pass
+
+
+@pytest.fixture
+def stub_models(monkeypatch):
+  monkeypatch.setitem(mit.models_train, 'stub', [sys.executable, '-c', STUB])
+  monkeypatch.setattr(mit, 'start_pmon', _no_monitors)
+  monkeypatch.setattr(mit, 'start_gpu_monitors', _no_monitors)
+  monkeypatch.setattr(mit, '_STAGGER_MIN_DELAY', 0)
+
+
+def _runs(experiment_path, experiment_index):
+  runs = []
+  for path in glob.glob(os.path.join(experiment_path, str(experiment_index), '*', 'output.log')):
+    with open(path) as f:
+      device, start, end = f.read().split()
+    runs.append((device, float(start), float(end)))
+  return runs
+
+
+def test_sets_are_sharded_over_devices(tmpdir, stub_models):
+  experiment_path = str(tmpdir)
+  sets = [['stub', 'stub'], ['stub'], ['stub'], ['stub']]
+  asyncio.run(mit.run_on_devices_async(8, os.path.join(experiment_path, 'average.log'), experiment_path, sets, DEVICES))
+
+  held = {device: [] for device in DEVICES}
+  for i, models in enumerate(sets):
+    runs = _runs(experiment_path, i)
+    assert len(runs) == len(models)
+    devices = set(device for device, _, _ in runs)
+    # every model of a set runs on the one device the set was given.
+    assert len(devices) == 1 and devices <= set(DEVICES)
+    held[devices.pop()].append((min(start for _, start, _ in runs), max(end for _, _, end in runs)))
+
+  # more sets than devices, so devices were released and handed out again, never to two sets at once.
+  assert all(len(spans) > 0 for spans in held.values())
+  assert sum(len(spans) for spans in held.values()) == len(sets)
+  for spans in held.values():
+    spans = sorted(spans)
+    assert all(end <= next_start for (_, end), (next_start, _) in zip(spans, spans[1:]))
@@ -0,0 +1,73 @@
+"""
+Batched augmentation of (N, C, H, W) tensors.
+
+Every image of the batch still gets its own random flips and crop offset, but they are
+drawn and applied with a handful of tensor ops for the whole batch on whatever device
+the batch lives on, instead of one python transform call per image in the loader.
+"""
+import torch
+import torch.nn.functional as F
+
+# per channel (mean, std) of the training splits.
+NORMALIZATION = {
+  'cifar10': ((0.4914, 0.4822, 0.4465), (0.2470, 0.2435, 0.2616)),
+  'svhn': ((0.4377, 0.4438, 0.4728), (0.1980, 0.2010, 0.1970)),
+  'fashionmnist': ((0.2860,), (0.3530,)),
+  'imagenet': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+}
+
+
+def random_flip(batch, dim):
+  """Flips every image of a (N, C, H, W) batch along dim with probability 0.5."""
+  flip = torch.rand(batch.size(0), device=batch.device) < 0.5
+  return torch.where(flip.view(-1, 1, 1, 1), batch.flip(dim), batch)
+
+def random_crop(batch, padding):
+  """Zero pads the batch by padding on every side and crops every image back at its own random offset."""
+  n, c, h, w = batch.shape
+  padded = F.pad(batch, (padding, padding, padding, padding))
+  padded_w = w + 2 * padding
+  offset_y = torch.randint(0, 2 * padding + 1, (n, 1, 1), device=batch.device)
+  offset_x = torch.randint(0, 2 * padding + 1, (n, 1, 1), device=batch.device)
+  # NOTE: one gather over the flattened padded images, the index of pixel (y, x) of image i
+  # is (offset_y[i] + y) * padded_w + offset_x[i] + x, shared by all channels.
+  rows = offset_y + torch.arange(h, device=batch.device).view(1, h, 1)
+  cols = offset_x + torch.arange(w, device=batch.device).view(1, 1, w)
+  index = (rows * padded_w + cols).view(n, 1, h * w).expand(n, c, h * w)
+  return padded.view(n, c, -1).gather(2, index).view(n, c, h, w)
+
+
+class BatchAugment(object):
+  """
+    Random vertical/horizontal flips, padded random crop and normalization of a batch.
+    Called with train=False only the normalization is applied, as for evaluation.
+  """
+  def __init__(self, flip=True, crop_padding=0, mean=None, std=None):
+    self.flip = flip
+    self.crop_padding = crop_padding
+    self.mean = mean
+    self.std = std
+    self._stats = {}
+
+  @classmethod
+  def for_dataset(cls, dataset, flip=True, crop_padding=0):
+    mean, std = NORMALIZATION.get(dataset, (None, None))
+    return cls(flip, crop_padding, mean, std)
+
+  def _normalization(self, batch):
+    # NOTE: keep one (mean, std) pair per device and dtype, so the host values are copied once.
+    key = (batch.device, batch.dtype)
+    if key not in self._stats:
+      self._stats[key] = (torch.tensor(self.mean, device=batch.device, dtype=batch.dtype).view(1, -1, 1, 1),
+                          torch.tensor(self.std, device=batch.device, dtype=batch.dtype).view(1, -1, 1, 1))
+    return self._stats[key]
+
+  def __call__(self, batch, train=True):
+    if train and self.flip:
+      batch = random_flip(random_flip(batch, 2), 3)
+    if train and self.crop_padding > 0:
+      batch = random_crop(batch, self.crop_padding)
+    if self.mean is not None:
+      mean, std = self._normalization(batch)
+      batch = (batch - mean) / std
+    return batch
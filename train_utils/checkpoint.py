@@ -0,0 +1,309 @@
+"""
+Atomic, rotating and asynchronous checkpoints of {'epoch', 'model_state_dict', 'optim_state_dict'}.
+
+A checkpoint is first copied to host memory (snapshot), which is the only part the training
+loop waits for, then serialized to a tmp file next to its final name and renamed into
+place, so a crash mid-write never leaves a torn or missing checkpoint. Files are named
+model_state_epoch_<epoch>.<pth|flat> and only the newest keep of them are kept.
+CheckpointWriter does the serialization on a background thread.
+
+Two formats: 'torch' is torch.save, 'flat' is a JSON index of the nested states followed
+by the raw bytes of every tensor. A flat checkpoint is memory mapped when loaded, its
+tensors are views of the file that are only read when copied into the model or the
+optimizer, straight to their device, and the parts that are not restored are never read.
+"""
+import os
+import re
+import json
+import queue
+import struct
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+CKPT_PREFIX = 'model_state_epoch'
+_CKPT_RE = re.compile(r'^%s(?:_(\d+))?\.(pth|flat)$' % CKPT_PREFIX)
+EXTENSIONS = {'torch': 'pth', 'flat': 'flat'}
+
+FLAT_MAGIC = b'FLATCKPT'
+# NOTE: tensor data starts at multiples of this, so every dtype can view its bytes in place.
+FLAT_ALIGN = 64
+_DTYPES = {str(dtype): dtype for dtype in [
+  torch.float64, torch.float32, torch.float16, torch.bfloat16,
+  torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool]}
+
+
+def ckpt_path(ckpt_dir, epoch, ckpt_format='torch'):
+  return os.path.join(ckpt_dir, '%s_%d.%s' % (CKPT_PREFIX, epoch, EXTENSIONS[ckpt_format]))
+
+
+def list_checkpoints(ckpt_dir):
+  """Checkpoint paths of ckpt_dir, newest first. The unnumbered model_state_epoch.pth of older runs comes last."""
+  if ckpt_dir is None or not os.path.isdir(ckpt_dir):
+    return []
+  found = []
+  for name in os.listdir(ckpt_dir):
+    match = _CKPT_RE.match(name)
+    if match is None:
+      continue
+    epoch = int(match.group(1)) if match.group(1) is not None else -1
+    found.append((epoch, os.path.join(ckpt_dir, name)))
+  return [path for _, path in sorted(found, reverse=True)]
+
+
+def to_host(obj):
+  """Copy of obj with every tensor detached and copied to cpu, so training can go on updating the originals."""
+  if isinstance(obj, torch.Tensor):
+    return obj.detach().to('cpu', copy=True)
+  if isinstance(obj, dict):
+    copy = type(obj)((k, to_host(v)) for k, v in obj.items())
+    # NOTE: the versions of the modules of a state_dict, load_state_dict hands them to the modules.
+    if hasattr(obj, '_metadata'):
+      copy._metadata = obj._metadata
+    return copy
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(to_host(v) for v in obj)
+  return obj
+
+
+def snapshot(epoch, model, optimizer):
+  return {'epoch': epoch, 'model_state_dict': to_host(model.state_dict()), 'optim_state_dict': to_host(optimizer.state_dict())}
+
+
+def encode_states(obj, tensors):
+  """JSON-able structure of obj, tensors are appended to tensors and replaced by their index."""
+  if isinstance(obj, torch.Tensor):
+    tensors.append(obj)
+    return {'__tensor__': len(tensors) - 1}
+  if isinstance(obj, dict):
+    # NOTE: keys are kept as a list of pairs, the optimizer state is keyed by int.
+    encoded = {'__dict__': [[k, encode_states(v, tensors)] for k, v in obj.items()]}
+    # NOTE: the module versions of a state_dict, see to_host.
+    if getattr(obj, '_metadata', None) is not None:
+      encoded['__metadata__'] = encode_states(obj._metadata, tensors)
+    return encoded
+  if isinstance(obj, tuple):
+    return {'__tuple__': [encode_states(v, tensors) for v in obj]}
+  if isinstance(obj, list):
+    return [encode_states(v, tensors) for v in obj]
+  if obj is None or isinstance(obj, (bool, int, float, str)):
+    return obj
+  raise TypeError('can not write %s to a flat checkpoint' % type(obj).__name__)
+
+
+def decode_states(obj, tensor):
+  """Inverse of encode_states, tensor(i) gives the i-th tensor."""
+  if isinstance(obj, list):
+    return [decode_states(v, tensor) for v in obj]
+  if not isinstance(obj, dict):
+    return obj
+  if '__tensor__' in obj:
+    return tensor(obj['__tensor__'])
+  if '__tuple__' in obj:
+    return tuple(decode_states(v, tensor) for v in obj['__tuple__'])
+  if '__metadata__' in obj:
+    decoded = OrderedDict((k, decode_states(v, tensor)) for k, v in obj['__dict__'])
+    decoded._metadata = decode_states(obj['__metadata__'], tensor)
+    return decoded
+  return dict((k, decode_states(v, tensor)) for k, v in obj['__dict__'])
+
+
+def _align(offset):
+  return (offset + FLAT_ALIGN - 1) // FLAT_ALIGN * FLAT_ALIGN
+
+
+def write_flat(states, f):
+  """magic, header length, JSON header {'states', 'tensors': [[dtype, shape, offset, nbytes]]}, aligned tensor bytes."""
+  tensors = []
+  encoded = encode_states(states, tensors)
+  tensors = [t.detach().cpu().contiguous() for t in tensors]
+  for t in tensors:
+    if str(t.dtype) not in _DTYPES:
+      raise TypeError('can not write %s tensors to a flat checkpoint' % str(t.dtype))
+  index = []
+  offset = 0
+  for t in tensors:
+    nbytes = t.numel() * t.element_size()
+    index.append([str(t.dtype), list(t.shape), offset, nbytes])
+    offset = _align(offset + nbytes)
+  header = json.dumps({'states': encoded, 'tensors': index}).encode('utf-8')
+  data_start = _align(len(FLAT_MAGIC) + 8 + len(header))
+  f.write(FLAT_MAGIC + struct.pack('<Q', len(header)) + header)
+  f.write(b'\0' * (data_start - len(FLAT_MAGIC) - 8 - len(header)))
+  written = 0
+  for t, (_, _, offset, nbytes) in zip(tensors, index):
+    f.write(b'\0' * (offset - written))
+    if nbytes > 0:
+      f.write(memoryview(t.reshape(-1).view(torch.uint8).numpy()))
+    written = offset + nbytes
+
+
+class FlatCheckpoint(object):
+  """
+    Memory mapped flat checkpoint, indexed like the states dict it was written from:
+    ckpt['model_state_dict'] decodes only that part, and its tensors are read-only views
+    of the file until they are copied somewhere.
+  """
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      if f.read(len(FLAT_MAGIC)) != FLAT_MAGIC:
+        raise ValueError('not a flat checkpoint')
+      header_size, = struct.unpack('<Q', f.read(8))
+      header = json.loads(f.read(header_size).decode('utf-8'))
+    self.data_start = _align(len(FLAT_MAGIC) + 8 + header_size)
+    self.index = header['tensors']
+    self.states = header['states']['__dict__']
+    data_end = self.data_start + max([offset + nbytes for _, _, offset, nbytes in self.index] + [0])
+    if os.path.getsize(path) < data_end:
+      raise ValueError('truncated flat checkpoint')
+    # NOTE: copy on write, so torch gets writable arrays and the file is never modified.
+    self.data = np.memmap(path, dtype=np.uint8, mode='c') if data_end > self.data_start else None
+
+  def _tensor(self, i):
+    dtype, shape, offset, nbytes = self.index[i]
+    if nbytes == 0:
+      return torch.empty(shape, dtype=_DTYPES[dtype])
+    start = self.data_start + offset
+    return torch.from_numpy(self.data[start:start + nbytes]).view(_DTYPES[dtype]).view(shape)
+
+  def keys(self):
+    return [k for k, _ in self.states]
+
+  def __contains__(self, key):
+    return key in self.keys()
+
+  def __getitem__(self, key):
+    for k, v in self.states:
+      if k == key:
+        return decode_states(v, self._tensor)
+    raise KeyError(key)
+
+
+def write_atomic(states, path):
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    if path.endswith('.flat'):
+      write_flat(states, f)
+    else:
+      torch.save(states, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+
+
+def rotate(ckpt_dir, keep):
+  for path in list_checkpoints(ckpt_dir)[keep:]:
+    os.remove(path)
+
+
+def save_checkpoint(states, ckpt_dir, keep=1, ckpt_format='torch'):
+  """Writes states as the checkpoint of states['epoch'], then drops all but the newest keep checkpoints."""
+  os.makedirs(ckpt_dir, exist_ok=True)
+  path = ckpt_path(ckpt_dir, states['epoch'], ckpt_format)
+  write_atomic(states, path)
+  rotate(ckpt_dir, keep)
+  return path
+
+
+def load_checkpoint(path, map_location=None):
+  """The states of a torch checkpoint, or the FlatCheckpoint of a flat one, which map_location does not apply to."""
+  if path.endswith('.flat'):
+    return FlatCheckpoint(path)
+  return torch.load(path, map_location=map_location)
+
+
+def load_latest_checkpoint(ckpt_dir, map_location=None, logger=None):
+  """
+    (path, states) of the newest checkpoint of ckpt_dir that loads, (None, None) if there
+    is none. Checkpoints that fail to load, e.g. truncated by a crash, are skipped.
+  """
+  for path in list_checkpoints(ckpt_dir):
+    try:
+      states = load_checkpoint(path, map_location)
+    except Exception as e:
+      if logger is not None:
+        logger.warning("Skipping unreadable ckpt %s: %s: %s", path, type(e).__name__, str(e).split("\n")[0])
+      continue
+    return path, states
+  return None, None
+
+
+def restore_checkpoint(states, model=None, optimizer=None):
+  """
+    Loads the model and/or the optimizer (None skips it) from the states of a checkpoint
+    and returns its epoch. Load model and optimizer once their parameters are on their
+    device: load_state_dict copies the tensors straight there, also the optimizer state.
+  """
+  if model is not None:
+    model.load_state_dict(states['model_state_dict'])
+  if optimizer is not None:
+    optimizer.load_state_dict(states['optim_state_dict'])
+  return states['epoch']
+
+
+class CheckpointWriter(object):
+  """
+    Saves checkpoints of ckpt_dir from a background thread. save() only waits for the host
+    snapshot, and for the previous write if it is still running, so at most one snapshot
+    is held in memory. Errors of a write are raised by the next save() or close().
+    With background=False save() writes in the calling thread.
+  """
+  _END = object()
+
+  def __init__(self, ckpt_dir, keep=1, logger=None, background=True, ckpt_format='torch'):
+    self.ckpt_dir = ckpt_dir
+    self.keep = keep
+    self.ckpt_format = ckpt_format
+    self.logger = logger
+    self.error = None
+    os.makedirs(ckpt_dir, exist_ok=True)
+    # NOTE: leftovers of a write that crashed.
+    for name in os.listdir(ckpt_dir):
+      if name.startswith(CKPT_PREFIX) and name.endswith('.tmp'):
+        os.remove(os.path.join(ckpt_dir, name))
+    self.pending = queue.Queue(maxsize=1)
+    self.thread = None
+    if background:
+      self.thread = threading.Thread(target=self._run, daemon=True)
+      self.thread.start()
+
+  def _run(self):
+    while True:
+      states = self.pending.get()
+      try:
+        if states is self._END:
+          return
+        path = save_checkpoint(states, self.ckpt_dir, self.keep, self.ckpt_format)
+        if self.logger is not None:
+          self.logger.info("saved ckpt: %s", path)
+      except Exception as e:
+        self.error = e
+      finally:
+        self.pending.task_done()
+
+  def _raise(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def save(self, epoch, model, optimizer):
+    if self.logger is not None:
+      self.logger.info("saving ckpt: %d", epoch)
+    if self.thread is None:
+      save_checkpoint(snapshot(epoch, model, optimizer), self.ckpt_dir, self.keep, self.ckpt_format)
+      return
+    self.wait()
+    self.pending.put(snapshot(epoch, model, optimizer))
+
+  def wait(self):
+    """Blocks until every checkpoint handed to save() is written."""
+    self.pending.join()
+    self._raise()
+
+  def close(self):
+    if self.thread is not None and self.thread.is_alive():
+      self.pending.put(self._END)
+      self.thread.join()
+    self._raise()
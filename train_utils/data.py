@@ -1,33 +1,189 @@
+import os
+import numpy as np
+import torch
 from torchvision import transforms
 from torch.utils.data import DataLoader
+from train_utils.augment import BatchAugment
 import train_utils.distribute as distribute_utils
 
-def get_dataset(dataset_fn, dataset_dir, download=False):
-  # TODO: currently this is the only transforms.
-  compose_trans = transforms.Compose([
-      transforms.RandomVerticalFlip(),
-      transforms.RandomHorizontalFlip(),
-      transforms.ToTensor()
-    ])
+def _make_split(dataset_fn, dataset_dir, train, transform=None, download=False):
+  # NOTE: SVHN names its splits instead of taking train=True/False.
+  if dataset_fn.__name__ == 'SVHN':
+    return dataset_fn(dataset_dir, split='train' if train else 'test', transform=transform, download=download)
+  return dataset_fn(dataset_dir, transform=transform, train=train, download=download)
+
+def get_dataset(dataset_fn, dataset_dir, download=False, random_flips=True):
+  # NOTE: without random_flips the samples are plain tensors, to be augmented per batch by train_utils.augment.
+  if random_flips:
+    compose_trans = transforms.Compose([
+        transforms.RandomVerticalFlip(),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor()
+      ])
+  else:
+    compose_trans = transforms.ToTensor()
   
-  train_dataset = dataset_fn(dataset_dir, transform=compose_trans, train=True, download=download)
-  val_dataset = dataset_fn(dataset_dir, transform=compose_trans, train=False, download=download)
+  train_dataset = _make_split(dataset_fn, dataset_dir, True, compose_trans, download)
+  val_dataset = _make_split(dataset_fn, dataset_dir, False, compose_trans, download)
   return train_dataset, val_dataset
 
-def get_standard_dataloader(dataset_fn, dataset_dir, batch_size, threadiness=2, shuffle=True, download=True):
-  train_dataset, val_dataset = get_dataset(dataset_fn, dataset_dir, download=download)
+def worker_options(threadiness, persistent_workers=False, prefetch_factor=None):
+  """DataLoader worker keywords, both options only exist with worker processes."""
+  if threadiness == 0:
+    return {}
+  options = {'persistent_workers': persistent_workers}
+  if prefetch_factor is not None:
+    options['prefetch_factor'] = prefetch_factor
+  return options
+
+def get_standard_dataloader(dataset_fn, dataset_dir, batch_size, threadiness=2, shuffle=True, download=True, cache=False, random_flips=True, pin_memory=False,
+                            persistent_workers=False, prefetch_factor=None):
+  if cache:
+    train_dataset, val_dataset = get_cached_dataset(dataset_fn, dataset_dir, download=download)
+    return (CachedLoader(train_dataset, batch_size, shuffle=shuffle, flip=random_flips),
+            CachedLoader(val_dataset, batch_size, shuffle=shuffle, flip=random_flips))
+  train_dataset, val_dataset = get_dataset(dataset_fn, dataset_dir, download=download, random_flips=random_flips)
+  # NOTE: with persistent workers every loader forks its workers once, not at every epoch.
+  worker_kwargs = worker_options(threadiness, persistent_workers, prefetch_factor)
   train_loader = DataLoader(train_dataset, 
                             batch_size=batch_size, 
                             shuffle=shuffle, 
-                            num_workers=threadiness)
+                            num_workers=threadiness,
+                            pin_memory=pin_memory,
+                            **worker_kwargs)
   val_loader = DataLoader(val_dataset, 
                           batch_size=batch_size, 
                           shuffle=shuffle, 
-                          num_workers=threadiness)
+                          num_workers=threadiness,
+                          pin_memory=pin_memory,
+                          **worker_kwargs)
   return train_loader, val_loader
 
-def get_distribute_dataloader(dataset_fn, dataset_dir, batch_size, threadiness, download):
-  train_dataset, val_dataset = get_dataset(dataset_fn, dataset_dir, download=download)
-  sampler, dist_train_loader = distribute_utils.distributed_dataloader(train_dataset, threadiness, batch_size)
-  val_loader = DataLoader(val_dataset, batch_size, shuffle=False, num_workers=threadiness)
+def get_distribute_dataloader(dataset_fn, dataset_dir, batch_size, threadiness, download, cache=False, random_flips=True, pin_memory=False,
+                              persistent_workers=False, prefetch_factor=None):
+  if cache:
+    train_dataset, val_dataset = get_cached_dataset(dataset_fn, dataset_dir, download=download)
+    sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+    return (sampler, CachedLoader(train_dataset, batch_size, sampler=sampler, flip=random_flips),
+            CachedLoader(val_dataset, batch_size, shuffle=False, flip=random_flips))
+  train_dataset, val_dataset = get_dataset(dataset_fn, dataset_dir, download=download, random_flips=random_flips)
+  worker_kwargs = worker_options(threadiness, persistent_workers, prefetch_factor)
+  sampler, dist_train_loader = distribute_utils.distributed_dataloader(train_dataset, threadiness, batch_size, pin_memory=pin_memory, **worker_kwargs)
+  val_loader = DataLoader(val_dataset, batch_size, shuffle=False, num_workers=threadiness, pin_memory=pin_memory, **worker_kwargs)
   return sampler, dist_train_loader, val_loader
+
+
+# Pre-decoded cache.
+# The split is decoded once into a (N, C, H, W) uint8 .npy next to the dataset and memory
+# mapped afterwards, batches are sliced out of it and flipped by train_utils.augment, so no
+# PIL decoding and no per-sample python transforms happen while training.
+
+def cache_paths(dataset_fn, dataset_dir, train):
+  prefix = os.path.join(dataset_dir, 'cache', '%s_%s' % (dataset_fn.__name__.lower(), 'train' if train else 'test'))
+  return prefix + '_images.npy', prefix + '_labels.npy'
+
+def build_cache(dataset_fn, dataset_dir, train, download=False):
+  images_path, labels_path = cache_paths(dataset_fn, dataset_dir, train)
+  os.makedirs(os.path.dirname(images_path), exist_ok=True)
+  dataset = _make_split(dataset_fn, dataset_dir, train, download=download)
+  first = np.asarray(dataset[0][0], dtype=np.uint8)
+  # NOTE: grayscale images decode to (H, W), keep a channel dim like ToTensor.
+  shape = (1,) + first.shape if first.ndim == 2 else (first.shape[2],) + first.shape[:2]
+  # NOTE: write to tmp files and rename, several ranks may build the same cache at once.
+  images_tmp = images_path + '.%d.tmp' % os.getpid()
+  labels_tmp = labels_path + '.%d.tmp' % os.getpid()
+  images = np.lib.format.open_memmap(images_tmp, mode='w+', dtype=np.uint8, shape=(len(dataset),) + shape)
+  labels = np.empty(len(dataset), dtype=np.int64)
+  for i in range(len(dataset)):
+    img, label = dataset[i]
+    img = np.asarray(img, dtype=np.uint8)
+    images[i] = img.reshape(shape) if img.ndim == 2 else img.transpose(2, 0, 1)
+    labels[i] = label
+  images.flush()
+  del images
+  # NOTE: np.save appends .npy to names that do not end with it.
+  with open(labels_tmp, 'wb') as f:
+    np.save(f, labels)
+  os.replace(images_tmp, images_path)
+  os.replace(labels_tmp, labels_path)
+
+class CachedDataset(torch.utils.data.Dataset):
+  """A decoded split memory mapped from its cache, items are uint8 (C, H, W) tensors."""
+  def __init__(self, images_path, labels_path):
+    self.images = np.load(images_path, mmap_mode='r')
+    self.labels = np.load(labels_path)
+
+  def __len__(self):
+    return len(self.labels)
+
+  def __getitem__(self, index):
+    return torch.from_numpy(np.array(self.images[index])), int(self.labels[index])
+
+  def get_batch(self, indices):
+    # NOTE: sorted indices turn the gather into mostly sequential reads of the memmap.
+    indices = np.sort(np.asarray(indices))
+    return torch.from_numpy(self.images[indices]), torch.from_numpy(self.labels[indices])
+
+def get_cached_dataset(dataset_fn, dataset_dir, download=False):
+  splits = []
+  for train in (True, False):
+    images_path, labels_path = cache_paths(dataset_fn, dataset_dir, train)
+    if not (os.path.exists(images_path) and os.path.exists(labels_path)):
+      build_cache(dataset_fn, dataset_dir, train, download=download)
+    splits.append(CachedDataset(images_path, labels_path))
+  return splits[0], splits[1]
+
+class CachedLoader(object):
+  """
+    Iterates a CachedDataset in batches of float (N, C, H, W) tensors in [0, 1] with the
+    same random vertical and horizontal flips as get_dataset, applied per batch.
+    Takes a sampler (e.g. a DistributedSampler) in place of shuffle, like DataLoader.
+  """
+  def __init__(self, dataset, batch_size, shuffle=True, sampler=None, flip=True):
+    self.dataset = dataset
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.sampler = sampler
+    # NOTE: flips only, crops and normalization are left to the training loop.
+    self.augment = BatchAugment(crop_padding=0) if flip else None
+
+  def __len__(self):
+    num = len(self.sampler) if self.sampler is not None else len(self.dataset)
+    return (num + self.batch_size - 1) // self.batch_size
+
+  def _indices(self):
+    if self.sampler is not None:
+      return np.fromiter(iter(self.sampler), dtype=np.int64)
+    if self.shuffle:
+      return torch.randperm(len(self.dataset)).numpy()
+    return np.arange(len(self.dataset))
+
+  def __iter__(self):
+    indices = self._indices()
+    for start in range(0, len(indices), self.batch_size):
+      images, labels = self.dataset.get_batch(indices[start:start+self.batch_size])
+      images = images.float().div_(255)
+      if self.augment is not None:
+        images = self.augment(images)
+      yield images, labels
+
+
+class SyntheticLoader(object):
+  """
+    Feeds the same random batch every step, allocated once on device, for as many steps
+    per epoch as the real split of num_samples would take, so no input pipeline runs at all.
+  """
+  def __init__(self, shape, num_classes, batch_size, num_samples, device='cpu'):
+    # NOTE: only len() of the dataset is used, by the step logs.
+    self.dataset = range(num_samples)
+    self.batch_size = batch_size
+    # NOTE: same value range as ToTensor.
+    self.images = torch.rand((batch_size,) + tuple(shape), device=device)
+    self.labels = torch.randint(0, num_classes, (batch_size,), device=device)
+
+  def __len__(self):
+    return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+  def __iter__(self):
+    for _ in range(len(self)):
+      yield self.images, self.labels
@@ -0,0 +1,185 @@
+"""
+allennlp Checkpointer that only writes what changed since the last full snapshot.
+
+Every tensor of the model and training states is cut into chunk_bytes chunks, and every
+chunk is keyed by its content hash (blake2b). A save writes either a base, a flat
+checkpoint (see train_utils.checkpoint) of every tensor, or a delta holding only the chunks
+whose hash differs from the base, e.g. the rows of an embedding table that were updated.
+Deltas are always against the base, so a restore reads the base and at most one delta.
+The base is compacted, i.e. written again from the current states, after compact_every
+deltas, once a delta grows past compact_ratio of the base, or when the tensors change.
+
+Files in serialization_dir: base_<seq>.flat, delta_<seq>_<base seq>.flat and best.json,
+which points at the best checkpoint so far. Files are written atomically and only the
+newest num_serialized_models_to_keep checkpoints, the best one and their bases are kept.
+"""
+import os
+import re
+import json
+import hashlib
+import logging
+from typing import Any, Dict, List, Tuple, Union
+
+import torch
+from allennlp.training.checkpointer import Checkpointer
+from train_utils.checkpoint import FlatCheckpoint, decode_states, encode_states, to_host, write_atomic
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+_FILE_RE = re.compile(r'^(base|delta)_(\d+)(?:_(\d+))?\.flat$')
+
+
+def _bytes(t: torch.Tensor):
+  """uint8 numpy view of the bytes of a contiguous cpu tensor."""
+  return t.reshape(-1).view(torch.uint8).numpy()
+
+
+def _hash(data) -> str:
+  return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def chunk_hashes(t: torch.Tensor, chunk_bytes: int) -> List[str]:
+  data = _bytes(t)
+  return [_hash(data[start:start + chunk_bytes]) for start in range(0, len(data), chunk_bytes)]
+
+
+class DeltaCheckpointer(Checkpointer):
+  """
+    Drop-in for the allennlp Checkpointer of DistributeTrainer and StepMetricsTrainer, see
+    the module docstring. keep_serialized_model_every_num_seconds is not supported.
+  """
+  def __init__(self,
+               serialization_dir: str = None,
+               keep_serialized_model_every_num_seconds: int = None,
+               num_serialized_models_to_keep: int = 2,
+               chunk_bytes: int = 1 << 18,
+               compact_every: int = 10,
+               compact_ratio: float = 0.5) -> None:
+    super().__init__(serialization_dir, keep_serialized_model_every_num_seconds, num_serialized_models_to_keep)
+    self._chunk_bytes = chunk_bytes
+    self._compact_every = compact_every
+    self._compact_ratio = compact_ratio
+    # NOTE: (seq, [(dtype, shape)], [chunk hashes per tensor], nbytes) of the base deltas are written against.
+    # A restarted run starts with a new base, the hashes of the old one are not kept.
+    self._base = None
+    self._deltas_since_base = 0
+    files = self._files()
+    self._seq = max([seq for seq, _, _, _ in files] + [0])
+
+  def _path(self, name: str) -> str:
+    return os.path.join(self._serialization_dir, name)
+
+  def _files(self) -> List[Tuple[int, str, int, str]]:
+    """(seq, 'base' or 'delta', base seq, path) of the checkpoints on disk, newest first."""
+    if self._serialization_dir is None or not os.path.isdir(self._serialization_dir):
+      return []
+    found = []
+    for name in os.listdir(self._serialization_dir):
+      match = _FILE_RE.match(name)
+      if match is None:
+        continue
+      seq = int(match.group(2))
+      base_seq = int(match.group(3)) if match.group(1) == 'delta' else seq
+      found.append((seq, match.group(1), base_seq, self._path(name)))
+    return sorted(found, reverse=True)
+
+  def _best_seq(self) -> int:
+    try:
+      with open(self._path('best.json'), 'r') as f:
+        return json.load(f)['seq']
+    except (OSError, ValueError, KeyError):
+      return None
+
+  def save_checkpoint(self,
+                      epoch: Union[int, str],
+                      model_state: Dict[str, Any],
+                      training_states: Dict[str, Any],
+                      is_best_so_far: bool) -> None:
+    if self._serialization_dir is None:
+      return
+    os.makedirs(self._serialization_dir, exist_ok=True)
+    states = to_host({'model': model_state, 'training': dict(training_states, epoch=epoch)})
+    tensors = []
+    structure = json.dumps(encode_states(states, tensors))
+    tensors = [t.contiguous() for t in tensors]
+    layout = [(str(t.dtype), list(t.shape)) for t in tensors]
+    hashes = [chunk_hashes(t, self._chunk_bytes) for t in tensors]
+    self._seq += 1
+
+    changed = []
+    if self._base is not None and self._base[1] == layout:
+      changed = [(ti, ci) for ti, (new, old) in enumerate(zip(hashes, self._base[2]))
+                 for ci, (h, base_h) in enumerate(zip(new, old)) if h != base_h]
+    changed_bytes = sum(min(self._chunk_bytes, tensors[ti].numel() * tensors[ti].element_size() - ci * self._chunk_bytes)
+                        for ti, ci in changed)
+    if (self._base is None or self._base[1] != layout or self._deltas_since_base >= self._compact_every
+        or changed_bytes > self._compact_ratio * self._base[3]):
+      path = self._path('base_%d.flat' % self._seq)
+      write_atomic({'seq': self._seq, 'structure': structure, 'tensors': tensors}, path)
+      self._base = (self._seq, layout, hashes, sum(t.numel() * t.element_size() for t in tensors))
+      self._deltas_since_base = 0
+      logger.info("Saved base ckpt %s", path)
+    else:
+      chunks = [torch.from_numpy(_bytes(tensors[ti])[ci * self._chunk_bytes:(ci + 1) * self._chunk_bytes]) for ti, ci in changed]
+      path = self._path('delta_%d_%d.flat' % (self._seq, self._base[0]))
+      write_atomic({'seq': self._seq, 'base': self._base[0], 'structure': structure, 'chunk_bytes': self._chunk_bytes,
+                    'changed': [[ti, ci, hashes[ti][ci]] for ti, ci in changed], 'chunks': chunks}, path)
+      self._deltas_since_base += 1
+      logger.info("Saved delta ckpt %s: %d of %d bytes changed", path, changed_bytes, self._base[3])
+
+    if is_best_so_far:
+      tmp_path = self._path('best.json.tmp')
+      with open(tmp_path, 'w') as f:
+        json.dump({'seq': self._seq, 'epoch': epoch}, f)
+      os.replace(tmp_path, self._path('best.json'))
+    self._prune()
+
+  def _prune(self) -> None:
+    files = self._files()
+    keep = set(seq for seq, _, _, _ in files[:self._num_serialized_models_to_keep])
+    best = self._best_seq()
+    if best is not None:
+      keep.add(best)
+    bases = set(base_seq for seq, _, base_seq, _ in files if seq in keep)
+    for seq, kind, _, path in files:
+      if seq not in keep and not (kind == 'base' and seq in bases):
+        os.remove(path)
+
+  def _load(self, seq: int, kind: str, base_seq: int) -> Dict[str, Any]:
+    base = FlatCheckpoint(self._path('base_%d.flat' % base_seq))
+    tensors = base['tensors']
+    structure = base['structure']
+    if kind == 'delta':
+      delta = FlatCheckpoint(self._path('delta_%d_%d.flat' % (seq, base_seq)))
+      chunk_bytes = delta['chunk_bytes']
+      structure = delta['structure']
+      # NOTE: the base is mapped copy on write, the chunks are written over its tensors in memory only.
+      for (ti, ci, h), chunk in zip(delta['changed'], delta['chunks']):
+        data = chunk.numpy()
+        if _hash(data) != h:
+          raise ValueError('chunk %d of tensor %d does not match its hash' % (ci, ti))
+        _bytes(tensors[ti])[ci * chunk_bytes:ci * chunk_bytes + len(data)] = data
+    return decode_states(json.loads(structure), lambda i: tensors[i])
+
+  def _load_seq(self, wanted: int = None) -> Dict[str, Any]:
+    """States of checkpoint wanted, or of the newest one that loads if wanted is None. {} if none."""
+    for seq, kind, base_seq, path in self._files():
+      if wanted is not None and seq != wanted:
+        continue
+      try:
+        return self._load(seq, kind, base_seq)
+      except Exception as e:  # pylint: disable=broad-except
+        logger.warning("Skipping unreadable ckpt %s: %s: %s", path, type(e).__name__, str(e).split('\n')[0])
+    return {}
+
+  def restore_checkpoint(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    states = self._load_seq()
+    if not states:
+      return {}, {}
+    return states['model'], states['training']
+
+  def best_model_state(self) -> Dict[str, Any]:
+    best = self._best_seq()
+    if best is None:
+      return {}
+    return self._load_seq(best).get('model', {})
@@ -1,30 +1,50 @@
 import torch
 import torch.distributed as dist
 from allennlp.models import Model
+from allennlp.data.iterators.data_iterator import TensorDict
+from allennlp.nn import util as nn_util
 from allennlp.training import util as allen_training_util
 from typing import Dict
 
-def distributed_dataloader(dataset, threads=2, batch_size=32):
+def distributed_dataloader(dataset, threads=2, batch_size=32, pin_memory=False, **worker_kwargs):
   train_sampler = torch.utils.data.distributed.DistributedSampler(dataset)
-  dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=(train_sampler is None), num_workers=threads, sampler=train_sampler)
+  dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=(train_sampler is None), num_workers=threads, sampler=train_sampler, pin_memory=pin_memory, **worker_kwargs)
   return train_sampler, dataloader
 
 
-def get_metrics(model: Model, device: torch.device, world_size: int, total_loss: float, num_batches: int, reset: bool = False) -> Dict[str, float]:
+def count_tokens(batch: TensorDict) -> int:
+  """Number of non padding tokens in the text fields of batch."""
+  return sum(int(nn_util.get_text_field_mask(field).sum()) for field in batch.values() if isinstance(field, dict))
+
+
+def throughput(num_samples: int, num_tokens: int, elapsed: float) -> Dict[str, float]:
+  elapsed = max(elapsed, 1e-9)
+  return {'samples_per_sec': num_samples / elapsed, 'tokens_per_sec': num_tokens / elapsed}
+
+
+def reduce_metrics(metrics: Dict[str, float], device: torch.device, world_size: int) -> Dict[str, float]:
+  """
+  Means of the metrics over the world_size processes, packed into one tensor so that
+  it is a single all_reduce and a single copy back to the host.
+  """
+  # NOTE: every rank has to pack the metrics in the same order.
+  names = sorted(metrics)
+  packed = torch.tensor([float(metrics[name]) for name in names], dtype=torch.float64, device=device)
+  dist.all_reduce(packed)
+  packed /= world_size
+  return dict(zip(names, packed.tolist()))
+
+
+def get_metrics(model: Model, device: torch.device, world_size: int, total_loss: float, num_batches: int, reset: bool = False, reduce: bool = True) -> Dict[str, float]:
   """
   Gets the metrics but sets ``"loss"`` to
   the total loss divided by the ``num_batches`` so that
   the ``"loss"`` metric is "average loss per batch".
+  With ``reduce`` they are averaged over all processes, otherwise they are the ones of this process.
   https://github.com/scarecrow1123/allennlp/commit/65036e7b7c4c169a04446237ebef87ece6ca8bfe#diff-7ad763815a56f9a0fa02c60ab6fabccb
   """
   metrics = model.get_metrics(reset=reset)
   metrics["loss"] = float(total_loss / num_batches) if num_batches > 0 else 0.0
-  aggregated_metrics = {}
-  for metric_name, metric_val in metrics.items():
-    metric_tensor = torch.tensor(metric_val).to(device)
-    metric_gathered = [torch.zeros_like(metric_tensor) for _ in range(world_size)]
-    
-    dist.all_gather(metric_gathered, metric_tensor)
-    metric_gathered = torch.tensor(metric_gathered)
-    aggregated_metrics[metric_name] = metric_gathered.mean().item()
-  return aggregated_metrics
+  if not reduce:
+    return {metric_name: float(metric_val) for metric_name, metric_val in metrics.items()}
+  return reduce_metrics(metrics, device, world_size)
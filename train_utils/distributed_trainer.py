@@ -25,7 +25,8 @@ from allennlp.training.metric_tracker import MetricTracker
 from allennlp.training.optimizers import Optimizer
 from allennlp.training.tensorboard_writer import TensorboardWriter
 from train_utils.distributed_trainer_base import DistributedTrainerBase
-from train_utils.distribute import get_metrics
+from train_utils.distribute import count_tokens, get_metrics, reduce_metrics, throughput
+from train_utils.step_metrics import StepMetricsWriter
 from allennlp.training import util as training_util
 from allennlp.training.moving_average import MovingAverage
 
@@ -65,11 +66,15 @@ class DistributeTrainer(DistributedTrainerBase):
                should_log_parameter_statistics: bool = True,
                should_log_learning_rate: bool = False,
                log_batch_size_period: Optional[int] = None,
-               moving_average: Optional[MovingAverage] = None) -> None:
+               moving_average: Optional[MovingAverage] = None,
+               step_metrics_file: Optional[str] = None,
+               metrics_interval: int = 1) -> None:
 
     super().__init__(rank, worldsize, ngpus_per_node, cuda_device, serialization_dir)
 
     self.model = model
+    # NOTE: the allennlp Model, for its own methods, when model is wrapped in DistributedDataParallel.
+    self._module = model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
     self.iterator = iterator
     self._validation_iterator = validation_iterator
     self.shuffle = shuffle
@@ -115,6 +120,14 @@ class DistributeTrainer(DistributedTrainerBase):
     self._log_batch_size_period = log_batch_size_period
 
     self._last_log = 0.0  # time of last logging
+
+    # NOTE: batches between two all_reduce of the training metrics, in between each rank reports its own.
+    self._metrics_interval = metrics_interval
+
+    # NOTE: one binary record per training batch, see train_utils.step_metrics
+    self._step_writer = None
+    if step_metrics_file is not None:
+      self._step_writer = StepMetricsWriter(step_metrics_file)
     
     # Enable activation logging.
     if histogram_interval is not None:
@@ -132,7 +145,7 @@ class DistributeTrainer(DistributedTrainerBase):
     try:
       loss = output_dict["loss"]
       if for_training:
-        loss += self.model.get_regularization_penalty()
+        loss += self._module.get_regularization_penalty()
     except KeyError:
       if for_training:
         raise RuntimeError("The model you are trying to optimize does not contain a"
@@ -145,6 +158,8 @@ class DistributeTrainer(DistributedTrainerBase):
     """ 
     Trains one epoch and returns metrics. 
     only report system utils when we are local rank 0 at each machine. 
+    The metrics are averaged over all ranks, samples_per_sec and tokens_per_sec are the
+    mean throughput of a rank.
     """
     logger.info("Rank %d: Epoch %d/%d", self._rank, epoch, self._num_epochs - 1)
     peak_cpu_usage = peak_memory_mb()
@@ -172,19 +187,30 @@ class DistributeTrainer(DistributedTrainerBase):
     if self._batch_num_total is None:
       self._batch_num_total = 0
 
-    histogram_parameters = set(self.model.get_parameters_for_histogram_tensorboard_logging())
+    histogram_parameters = set(self._module.get_parameters_for_histogram_tensorboard_logging())
 
     logger.info("Training")
     train_generator_tqdm = Tqdm.tqdm(train_generator,
                                       total=num_training_batches)
     cumulative_batch_size = 0
-    # NOTE: only work in nprocess_ngpus
-    device = torch.device("cuda:%d" % self._cuda_device[0])
+    tokens_this_epoch = 0
+    # NOTE: only work in nprocess_ngpus, a cuda_device of -1 trains on cpu, e.g. with gloo.
+    if self._cuda_device[0] >= 0:
+      device = torch.device("cuda:%d" % self._cuda_device[0])
+    else:
+      device = torch.device("cpu")
+    train_start_time = time.time()
     for batch_group in train_generator_tqdm:
+      step_start_time = time.time()
       batches_this_epoch += 1
       self._batch_num_total += 1
       batch_num_total = self._batch_num_total
 
+      # NOTE: counted on the batch before batch_loss moves it to the device, so no sync.
+      batch_size = sum([training_util.get_batch_size(batch) for batch in batch_group])
+      cumulative_batch_size += batch_size
+      tokens_this_epoch += sum([count_tokens(batch) for batch in batch_group])
+
       self.optimizer.zero_grad()
 
       loss = self.batch_loss(batch_group, for_training=True)
@@ -193,7 +219,8 @@ class DistributeTrainer(DistributedTrainerBase):
         raise ValueError("nan loss encountered")
       
       loss.backward()
-      train_loss += loss.item()
+      step_loss = loss.item()
+      train_loss += step_loss
       batch_grad_norm = self.rescale_gradients()
 
       # This does nothing if batch_num_total is None or you are using a
@@ -228,7 +255,13 @@ class DistributeTrainer(DistributedTrainerBase):
       if self._moving_average is not None:
         self._moving_average.apply(batch_num_total)
 
-      metrics = get_metrics(self.model, device, self._worldsize, train_loss, batches_this_epoch)
+      if self._step_writer is not None:
+        self._step_writer.write(time.time() - step_start_time, step_loss, batch_size)
+
+      metrics = get_metrics(self._module, device, self._worldsize, train_loss, batches_this_epoch, reduce=False)
+      metrics.update(throughput(cumulative_batch_size, tokens_this_epoch, time.time() - train_start_time))
+      if batches_this_epoch % self._metrics_interval == 0:
+        metrics = reduce_metrics(metrics, device, self._worldsize)
 
       description = training_util.description_from_metrics(metrics)
       train_generator_tqdm.set_description(("Rank %d: " % self._rank) + description, refresh=False)
@@ -243,16 +276,14 @@ class DistributeTrainer(DistributedTrainerBase):
           self._tensorboard.log_metrics({"epoch_metrics/" + k: v for k, v in metrics.items()})
 
         if self._tensorboard.should_log_histograms_this_batch():
-          self._tensorboard.log_histograms(self.model, histogram_parameters)
+          self._tensorboard.log_histograms(self._module, histogram_parameters)
 
       if self._log_batch_size_period:
-        cur_batch = sum([training_util.get_batch_size(batch) for batch in batch_group])
-        cumulative_batch_size += cur_batch
         if (batches_this_epoch - 1) % self._log_batch_size_period == 0:
           average = cumulative_batch_size/batches_this_epoch
-          logger.info(f"rank {self._rank}, current batch size: {cur_batch} mean batch size: {average}")
+          logger.info(f"rank {self._rank}, current batch size: {batch_size} mean batch size: {average}")
           if self._is_chief:
-            self._tensorboard.add_train_scalar("current_batch_size", cur_batch)
+            self._tensorboard.add_train_scalar("current_batch_size", batch_size)
             self._tensorboard.add_train_scalar("mean_batch_size", average)
       
       if self._is_chief:
@@ -264,10 +295,16 @@ class DistributeTrainer(DistributedTrainerBase):
           self._save_checkpoint(
                   '{0}.{1}'.format(epoch, training_util.time_to_str(int(last_save_time)))
           )
-      
-      metrics = get_metrics(self.model, device, self._worldsize, train_loss, batches_this_epoch)
-      metrics['cpu_memory_MB'] = peak_cpu_usage
-      return metrics
+
+    rank_throughput = throughput(cumulative_batch_size, tokens_this_epoch, time.time() - train_start_time)
+    logger.info("Rank %d: %d batches, %.1f samples/sec, %.1f tokens/sec", self._rank, batches_this_epoch,
+                rank_throughput['samples_per_sec'], rank_throughput['tokens_per_sec'])
+    # NOTE: every rank has to get here, it is a collective.
+    metrics = get_metrics(self._module, device, self._worldsize, train_loss, batches_this_epoch, reset=True, reduce=False)
+    metrics.update(rank_throughput)
+    metrics = reduce_metrics(metrics, device, self._worldsize)
+    metrics['cpu_memory_MB'] = peak_cpu_usage
+    return metrics
 
   def _validation_loss(self) -> Tuple[float, int]:
     """
@@ -310,7 +347,7 @@ class DistributeTrainer(DistributedTrainerBase):
             val_loss += loss.detach().cpu().numpy()
 
         # Update the description with the latest metrics
-        val_metrics = training_util.get_metrics(self.model, val_loss, batches_this_epoch)
+        val_metrics = training_util.get_metrics(self._module, val_loss, batches_this_epoch)
         description = training_util.description_from_metrics(val_metrics)
         val_generator_tqdm.set_description(description, refresh=False)
 
@@ -361,7 +398,7 @@ class DistributeTrainer(DistributedTrainerBase):
           with torch.no_grad():
             # We have a validation set, so compute all the metrics on it.
             val_loss, num_batches = self._validation_loss()
-            val_metrics = training_util.get_metrics(self.model, val_loss, num_batches, reset=True)
+            val_metrics = training_util.get_metrics(self._module, val_loss, num_batches, reset=True)
 
             # Check validation metric for early stopping
             this_epoch_val_metric = val_metrics[self._validation_metric]
@@ -424,6 +461,8 @@ class DistributeTrainer(DistributedTrainerBase):
 
     # make sure pending events are flushed to disk and files are closed properly
     self._tensorboard.close()
+    if self._step_writer is not None:
+      self._step_writer.close()
 
     # Load the best model state before returning
     if self._is_chief:
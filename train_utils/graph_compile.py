@@ -0,0 +1,126 @@
+"""
+Compiles a model for training with torch.compile ('inductor') or TorchScript ('torchscript').
+
+Each option falls back to the next one (inductor -> script -> trace -> eager) when the
+model does not compile, e.g. python control flow TorchScript can not type, or a wrapper
+like DistributedDataParallel. Compilation happens on a warm-up forward/backward pass
+before training, so its time is reported on its own and never shows up as sec/step.
+The outcome is kept per (model, backend, batch size, input shape) in a JSON file, so the
+next run of the same cell reports the previous compile time and skips options that failed.
+"""
+import os
+import json
+import time
+import torch
+
+FALLBACKS = {
+  'inductor': ['inductor', 'script', 'trace'],
+  'torchscript': ['script', 'trace'],
+}
+
+
+def compile_key(model_name, backend, batch_size, input_shape):
+  return '%s|%s|%d|%s' % (model_name, backend, batch_size, 'x'.join(str(d) for d in input_shape))
+
+
+class CompileCache(object):
+  """compile_key -> {'method', 'compile_secs', 'failed': {method: error}} kept in a JSON file."""
+  def __init__(self, path=None):
+    self.path = path
+    self.entries = {}
+    if path is not None and os.path.exists(path):
+      with open(path, 'r') as f:
+        self.entries = json.load(f)
+
+  def get(self, key):
+    return self.entries.get(key, {})
+
+  def put(self, key, entry):
+    self.entries[key] = entry
+    if self.path is None:
+      return
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    # NOTE: several runs may share the file, write to a tmp file and rename.
+    tmp_path = self.path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w') as f:
+      json.dump(self.entries, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, self.path)
+
+
+def _compile(model, method, example):
+  if method == 'inductor':
+    if not hasattr(torch, 'compile'):
+      raise RuntimeError('torch.compile needs torch >= 2.0')
+    return torch.compile(model)
+  if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+    raise RuntimeError('DistributedDataParallel can not be scripted or traced')
+  if method == 'script':
+    return torch.jit.script(model)
+  return torch.jit.trace(model, example)
+
+
+def _warmup(model, example, precision=None):
+  if precision is not None:
+    with precision.autocast():
+      out = model(example)
+  else:
+    out = model(example)
+  out.float().sum().backward()
+  if example.is_cuda:
+    torch.cuda.synchronize(example.device)
+
+
+def _error(e):
+  lines = [line for line in str(e).split('\n') if line.strip()]
+  return '%s: %s' % (type(e).__name__, lines[0].strip() if len(lines) > 0 else '')
+
+
+def _restore(model, buffers):
+  with torch.no_grad():
+    for b, saved in buffers:
+      b.copy_(saved)
+  for p in model.parameters():
+    p.grad = None
+
+
+def eval_model(model, compiled, method):
+  """
+    The model to evaluate with: compiled, unless it is traced. A traced graph keeps the
+    train mode it was traced in, .eval() does not reach its batchnorm and dropout.
+  """
+  return model if method == 'trace' else compiled
+
+
+def compile_model(model, backend, example, precision=None, cache=None, key=None, logger=None):
+  """
+    Returns (model to train with, method used, compile secs, previous compile secs or None).
+    The returned model shares its parameters with model, keep saving model itself, e.g.
+    torch.compile prefixes every state dict key with _orig_mod.
+  """
+  cache = cache if cache is not None else CompileCache()
+  entry = cache.get(key)
+  previous = entry.get('compile_secs')
+  failed = dict(entry.get('failed', {}))
+  # NOTE: tracing and the warm-up step run the model in train mode, put the batchnorm stats back after.
+  buffers = [(b, b.detach().clone()) for b in model.buffers()]
+  for method in FALLBACKS[backend]:
+    if method in failed:
+      if logger is not None:
+        logger.info("Compile: skipping %s, it failed before: %s", method, failed[method])
+      continue
+    start = time.time()
+    try:
+      compiled = _compile(model, method, example)
+      _warmup(compiled, example, precision)
+    except Exception as e:
+      failed[method] = _error(e)
+      if logger is not None:
+        logger.warning("Compile: %s failed, falling back: %s", method, failed[method])
+      continue
+    compile_secs = time.time() - start
+    _restore(model, buffers)
+    cache.put(key, {'method': method, 'compile_secs': compile_secs, 'failed': failed})
+    return compiled, method, compile_secs, previous
+  _restore(model, buffers)
+  cache.put(key, {'method': 'eager', 'compile_secs': 0.0, 'failed': failed})
+  return model, 'eager', 0.0, previous
@@ -0,0 +1,46 @@
+import math
+import time
+from typing import List
+
+import torch
+from allennlp.data.iterators.data_iterator import TensorDict
+from allennlp.training.trainer import Trainer
+from allennlp.training import util as training_util
+from train_utils.step_metrics import StepMetricsWriter
+
+
+class StepMetricsTrainer(Trainer):
+  """
+    allennlp Trainer that also writes one train_utils.step_metrics record per training batch.
+    NOTE: the step time is taken between consecutive training batch_loss calls, so it covers
+    forward, backward and optimizer step of a batch plus fetching the next one. The first
+    batch of every epoch only starts the clock.
+  """
+  def __init__(self, *args, step_metrics_file: str = None, **kwargs) -> None:
+    super().__init__(*args, **kwargs)
+    self._step_writer = None
+    if step_metrics_file is not None:
+      self._step_writer = StepMetricsWriter(step_metrics_file)
+    self._last_step_time = None
+
+  def batch_loss(self, batch_group: List[TensorDict], for_training: bool) -> torch.Tensor:
+    loss = super().batch_loss(batch_group, for_training)
+    if for_training and self._step_writer is not None:
+      now = time.time()
+      if self._last_step_time is not None:
+        batch_size = sum([training_util.get_batch_size(batch) for batch in batch_group])
+        self._step_writer.write(now - self._last_step_time, math.nan, batch_size)
+      self._last_step_time = now
+    return loss
+
+  def _train_epoch(self, epoch):
+    # NOTE: checkpointing, logging and validation between epochs are not a training step.
+    self._last_step_time = None
+    return super()._train_epoch(epoch)
+
+  def train(self):
+    try:
+      return super().train()
+    finally:
+      if self._step_writer is not None:
+        self._step_writer.close()
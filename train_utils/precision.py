@@ -0,0 +1,42 @@
+import torch
+
+DTYPES = {
+  'fp32': None,
+  'bf16': torch.bfloat16,
+  'fp16': torch.float16,
+}
+
+
+def _grad_scaler(device_type):
+  # NOTE: torch.amp.GradScaler takes the device from torch 2.3 on, before that it is cuda only.
+  if hasattr(torch.amp, 'GradScaler'):
+    return torch.amp.GradScaler(device_type)
+  return torch.cuda.amp.GradScaler()
+
+
+class Precision(object):
+  """
+    Runs forward and loss under autocast to bf16 or fp16 (nothing for fp32) on the device
+    type of device. fp16 also scales the loss with a GradScaler, so small gradients do not
+    underflow, and skips optimizer steps whose gradients overflowed.
+  """
+  def __init__(self, precision, device):
+    self.precision = precision
+    self.dtype = DTYPES[precision]
+    self.device_type = torch.device(device).type
+    self.scaler = _grad_scaler(self.device_type) if precision == 'fp16' else None
+
+  def autocast(self):
+    return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.dtype is not None)
+
+  def backward(self, loss):
+    if self.scaler is not None:
+      loss = self.scaler.scale(loss)
+    loss.backward()
+
+  def step(self, optimizer):
+    if self.scaler is None:
+      optimizer.step()
+      return
+    self.scaler.step(optimizer)
+    self.scaler.update()
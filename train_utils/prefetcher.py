@@ -0,0 +1,113 @@
+"""
+Overlaps getting the next batch onto the device with the compute of the current one.
+
+On cuda, CudaPrefetcher pins the next batch and issues its host to device copy on a side
+stream right after handing out the current batch, so the copy runs while the step computes
+(double buffering). Elsewhere ThreadPrefetcher keeps a background thread a few batches
+ahead of the loop. Both keep len() and .dataset of the wrapped loader, so the training
+loop does not change.
+"""
+import queue
+import threading
+import torch
+
+
+def _to_device(batch, device, non_blocking):
+  return tuple(t.to(device, non_blocking=non_blocking) for t in batch)
+
+
+class CudaPrefetcher(object):
+  """Stages the copy of batch i+1 on a side stream while batch i computes."""
+  def __init__(self, loader, device):
+    self.loader = loader
+    self.dataset = loader.dataset
+    self.device = torch.device(device)
+    self.stream = torch.cuda.Stream(self.device)
+
+  def __len__(self):
+    return len(self.loader)
+
+  def _preload(self, it):
+    try:
+      batch = next(it)
+    except StopIteration:
+      return None
+    with torch.cuda.stream(self.stream):
+      # NOTE: only a copy from pinned memory is asynchronous, DataLoader(pin_memory=True) already did it.
+      batch = tuple(t if t.is_pinned() else t.pin_memory() for t in batch)
+      return _to_device(batch, self.device, True)
+
+  def __iter__(self):
+    it = iter(self.loader)
+    batch = self._preload(it)
+    while batch is not None:
+      current = torch.cuda.current_stream(self.device)
+      current.wait_stream(self.stream)
+      # NOTE: the tensors were allocated on the side stream, tell the allocator they are used on this one.
+      for t in batch:
+        t.record_stream(current)
+      next_batch = self._preload(it)
+      yield batch
+      batch = next_batch
+
+
+class ThreadPrefetcher(object):
+  """Keeps up to depth batches ready from a background thread."""
+  _END = object()
+
+  def __init__(self, loader, device, depth=2):
+    self.loader = loader
+    self.dataset = loader.dataset
+    self.device = torch.device(device)
+    self.depth = depth
+
+  def __len__(self):
+    return len(self.loader)
+
+  def _fill(self, batches, stop):
+    try:
+      for batch in self.loader:
+        item = _to_device(batch, self.device, False)
+        while not stop.is_set():
+          try:
+            batches.put(item, timeout=0.1)
+            break
+          except queue.Full:
+            continue
+        if stop.is_set():
+          return
+      item = self._END
+    except Exception as e:
+      # NOTE: handed to the training loop, which raises it.
+      item = e
+    while not stop.is_set():
+      try:
+        batches.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        continue
+
+  def __iter__(self):
+    batches = queue.Queue(maxsize=self.depth)
+    stop = threading.Event()
+    filler = threading.Thread(target=self._fill, args=(batches, stop), daemon=True)
+    filler.start()
+    try:
+      while True:
+        item = batches.get()
+        if item is self._END:
+          return
+        if isinstance(item, Exception):
+          raise item
+        yield item
+    finally:
+      # NOTE: also reached when the loop stops early, the thread then drops what it has.
+      stop.set()
+      filler.join()
+
+
+def prefetch(loader, device, depth=2):
+  device = torch.device(device)
+  if device.type == 'cuda':
+    return CudaPrefetcher(loader, device)
+  return ThreadPrefetcher(loader, device, depth)
@@ -0,0 +1,46 @@
+"""
+Fixed size binary step records, written by the trainers and read by the orchestrator.
+
+Each record is (step, wall time, sec/step, loss, batch size) packed little endian, so the
+reader never parses text and a half written record at the end is simply left for later.
+"""
+import math
+import struct
+import time
+
+RECORD = struct.Struct('<qdddi4x')
+RECORD_SIZE = RECORD.size
+
+
+def iter_records(data):
+  """Unpacks every complete record in data, trailing partial bytes are ignored."""
+  usable = len(data) - len(data) % RECORD_SIZE
+  return RECORD.iter_unpack(data[:usable])
+
+
+class StepMetricsWriter(object):
+  """Appends one record per training step, buffered so a step costs a struct.pack."""
+  def __init__(self, path, flush_every=100):
+    self.path = path
+    self.flush_every = flush_every
+    self.step = 0
+    self._handle = open(path, 'ab')
+    self._pending = 0
+
+  def write(self, step_time, loss=math.nan, batch_size=0):
+    # NOTE: loss is nan for steps where the caller did not sync to fetch it.
+    self._handle.write(RECORD.pack(self.step, time.time(), step_time, loss, batch_size))
+    self.step += 1
+    self._pending += 1
+    # NOTE: the first record goes out at once, model_interference_test waits for it to start the next model.
+    if self._pending >= self.flush_every or self.step == 1:
+      self.flush()
+
+  def flush(self):
+    self._handle.flush()
+    self._pending = 0
+
+  def close(self):
+    if not self._handle.closed:
+      self.flush()
+      self._handle.close()
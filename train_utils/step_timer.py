@@ -0,0 +1,83 @@
+import time
+import torch
+
+PHASES = ('data', 'h2d', 'augment', 'forward', 'backward', 'optimizer')
+# NOTE: what the "sec/step" logs have always measured, the model compute of a step.
+COMPUTE_PHASES = ('forward', 'backward', 'optimizer')
+
+
+class StepTimer(object):
+  """
+    Splits every step into PHASES using time.perf_counter_ns.
+    With sync=True each phase boundary waits for the device first (no-op on cpu), so a
+    phase is the device work it launched rather than the launch latency.
+    The first warmup_steps steps (cudnn algorithm selection, allocator growth, ...) are
+    timed but left out of the accumulated statistics.
+    The 'data' phase is the time blocked on the loader, it is also kept for every step of
+    the epoch and of the run to tell how much of the wall time went into waiting for input.
+    Batched augmentation on the device has its own 'augment' phase.
+  """
+  def __init__(self, device, sync=False, warmup_steps=0):
+    self.device = torch.device(device)
+    self.sync = sync and self.device.type == 'cuda'
+    self.warmup_steps = warmup_steps
+    self.steps = 0
+    self.run_stall = 0
+    self.run_start = None
+    self.reset_stats()
+    self._durations = dict.fromkeys(PHASES, 0)
+    self._last = None
+
+  def reset_stats(self):
+    self.measured_steps = 0
+    self.totals = dict.fromkeys(PHASES, 0)
+    self.epoch_stall = 0
+
+  def _now(self):
+    if self.sync:
+      torch.cuda.synchronize(self.device)
+    return time.perf_counter_ns()
+
+  def start_step(self):
+    self._durations = dict.fromkeys(PHASES, 0)
+    self._last = self._now()
+    if self.run_start is None:
+      self.run_start = self._last
+
+  def mark(self, phase):
+    """Adds the time since the previous mark to phase, a phase can be marked more than once a step."""
+    now = self._now()
+    self._durations[phase] += now - self._last
+    self._last = now
+
+  def end_step(self):
+    """Returns the phases of the finished step in seconds and whether it counted towards the stats."""
+    measured = self.steps >= self.warmup_steps
+    self.steps += 1
+    self.epoch_stall += self._durations['data']
+    self.run_stall += self._durations['data']
+    if measured:
+      self.measured_steps += 1
+      for phase in PHASES:
+        self.totals[phase] += self._durations[phase]
+    return {phase: ns / 1e9 for phase, ns in self._durations.items()}, measured
+
+  def mean(self, phase):
+    if self.measured_steps == 0:
+      return 0.0
+    return self.totals[phase] / 1e9 / self.measured_steps
+
+  def summary(self):
+    return {phase: self.mean(phase) for phase in PHASES}
+
+  def stall_report(self):
+    """Returns secs blocked on the loader, wall secs and their ratio since the first step."""
+    if self.run_start is None:
+      return 0.0, 0.0, 0.0
+    wall = (time.perf_counter_ns() - self.run_start) / 1e9
+    stall = self.run_stall / 1e9
+    return stall, wall, (stall / wall if wall > 0 else 0.0)
+
+
+def compute_time(phases):
+  return sum(phases[phase] for phase in COMPUTE_PHASES)